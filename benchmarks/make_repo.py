@@ -0,0 +1,297 @@
+"""Generate synthetic mercurial repositories for benchmarking conversions.
+
+Commits are written directly with the mercurial API, so that large repositories can be
+generated quickly. The repository has a main line of development on the default
+branch, and a number of other lines forked from it:
+
+    named branches:   merged back into default every merge_every commits
+    anonymous heads:  further heads of default, never merged
+    bookmarked heads: further heads of default with a bookmark, never merged
+
+Each commit modifies files_per_commit files of its line, or adds new ones, with a
+fraction of text files being renamed. A fraction binary_ratio of files have binary
+contents. There can also be git subrepos, whose recorded revisions are updated from
+time to time, and tags. The output is deterministic for a given set of parameters and
+seed.
+
+Usage:
+
+    python make_repo.py [--profile=small|medium|large] [--commits=N ...] DEST
+"""
+import os
+import sys
+import random
+import argparse
+from binascii import hexlify
+
+from mercurial import context, hg, ui as uimod
+
+DEFAULTS = {
+    'commits': 1000,
+    'files_per_commit': 3,
+    'file_size': 4096,
+    'binary_ratio': 0.1,
+    'named_branches': 3,
+    'anonymous_heads': 2,
+    'bookmarked_heads': 2,
+    'merge_every': 20,
+    'rename_ratio': 0.02,
+    'subrepos': 1,
+    'tags': 10,
+    'seed': 0,
+}
+
+PROFILES = {
+    'small': {'commits': 200, 'file_size': 1024},
+    'medium': {'commits': 5000},
+    'large': {'commits': 50000, 'files_per_commit': 5, 'file_size': 16384},
+}
+
+USER = b'benchmark <benchmark@example.com>'
+
+# Fraction of the files changed by each commit that are new files:
+NEW_FILE_RATIO = 0.2
+
+# Seconds between commits:
+COMMIT_INTERVAL = 60
+
+
+class Line(object):
+    """A line of development: the tip of the line, its hg branch, the contents of its
+    files, and the files changed since it was last merged into default (None for
+    removed files)"""
+
+    def __init__(self, branch, node, files, bookmark=None, merges=False):
+        self.branch = branch
+        self.node = node
+        self.files = dict(files)
+        self.changed = {}
+        self.bookmark = bookmark
+        self.merges = merges
+
+
+class RepoGenerator(object):
+    def __init__(self, repo, params):
+        self.repo = repo
+        self.params = params
+        self.rng = random.Random(params['seed'])
+        self.timestamp = 1500000000
+        self.n_files = 0
+
+    def random_bytes(self, n):
+        return self.rng.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
+
+    def new_contents(self, binary):
+        size = max(1, int(self.rng.expovariate(1.0 / self.params['file_size'])))
+        if binary:
+            return b'\0' + self.random_bytes(size - 1)
+        text = hexlify(self.random_bytes((size + 1) // 2))[:size]
+        return b'\n'.join(text[i : i + 63] for i in range(0, len(text), 63)) + b'\n'
+
+    def modified_contents(self, data, binary):
+        """Return data with a random region of up to an eighth of it rewritten"""
+        new = self.new_contents(binary)[: max(1, len(data) // 8)]
+        if binary:
+            new = new.lstrip(b'\0') or b'\1'
+        start = self.rng.randrange(1 if binary else 0, max(2, len(data)))
+        return data[:start] + new + data[start + len(new) :]
+
+    def commit(self, line, changes, text, p2=None, copies=None):
+        """Commit changes (a dict of paths to new contents, or None to remove them)
+        on top of line, with p2 as a second parent if given, and update the line"""
+        copies = copies or {}
+
+        def getfilectx(repo, memctx, path):
+            if changes[path] is None:
+                return None
+            return context.memfilectx(
+                repo, memctx, path, changes[path], copysource=copies.get(path)
+            )
+
+        self.timestamp += COMMIT_INTERVAL
+        ctx = context.memctx(
+            self.repo,
+            (line.node, p2),
+            text,
+            sorted(changes),
+            getfilectx,
+            user=USER,
+            date=(self.timestamp, 0),
+            extra={b'branch': line.branch},
+        )
+        line.node = ctx.commit()
+        for path, data in changes.items():
+            if data is None:
+                line.files.pop(path, None)
+            else:
+                line.files[path] = data
+            line.changed[path] = data
+        return line.node
+
+    def commit_changes(self, line, i):
+        files_per_commit = self.params['files_per_commit']
+        changes = {}
+        copies = {}
+        regular = sorted(path for path in line.files if not path.startswith(b'.hg'))
+        n_new = sum(self.rng.random() < NEW_FILE_RATIO for _ in range(files_per_commit))
+        n_modified = min(len(regular), files_per_commit - n_new)
+        for path in self.rng.sample(regular, n_modified):
+            data = line.files[path]
+            binary = data.startswith(b'\0')
+            if not binary and self.rng.random() < self.params['rename_ratio']:
+                new_path = path + b'.renamed'
+                changes[path] = None
+                changes[new_path] = data
+                copies[new_path] = path
+            else:
+                changes[path] = self.modified_contents(data, binary)
+        for _ in range(files_per_commit - n_modified):
+            self.n_files += 1
+            binary = self.rng.random() < self.params['binary_ratio']
+            path = b'dir%d/file%d%s' % (
+                self.n_files % 16,
+                self.n_files,
+                b'.bin' if binary else b'.txt',
+            )
+            changes[path] = self.new_contents(binary)
+        self.commit(line, changes, b'commit %d' % i, copies=copies)
+
+    def merge(self, default, line, i):
+        changes = dict(
+            (path, data)
+            for path, data in line.changed.items()
+            if default.files.get(path) != data
+        )
+        if not changes:
+            return False
+        text = b'Merge %s into default' % line.branch
+        self.commit(default, changes, text, p2=line.node)
+        line.changed = {}
+        return True
+
+    def update_subrepos(self, line, i):
+        substate = b''.join(
+            b'%s sub%d\n' % (hexlify(self.random_bytes(20)), n)
+            for n in range(self.params['subrepos'])
+        )
+        changes = {b'.hgsubstate': substate}
+        if b'.hgsub' not in line.files:
+            changes[b'.hgsub'] = b''.join(
+                b'sub%d = [git]https://example.com/sub%d.git\n' % (n, n)
+                for n in range(self.params['subrepos'])
+            )
+        self.commit(line, changes, b'Update subrepos, commit %d' % i)
+
+    def tag(self, line, i):
+        hgtags = line.files.get(b'.hgtags', b'')
+        hgtags += b'%s tag-%d\n' % (hexlify(line.node), i)
+        self.commit(line, {b'.hgtags': hgtags}, b'Added tag tag-%d' % i)
+
+    def fork_points(self, n, start, stop):
+        """Return n commit indices at which to fork lines, spread over start:stop"""
+        if n == 0 or stop <= start:
+            return []
+        step = (stop - start) / float(n)
+        return [start + int(step * k) for k in range(n)]
+
+    def generate(self):
+        params = self.params
+        commits = params['commits']
+        default = Line(b'default', None, {})
+        lines = [default]
+        forks = {}
+        for n, i in enumerate(
+            self.fork_points(params['named_branches'], 1, commits // 2)
+        ):
+            forks.setdefault(i, []).append((b'branch-%d' % n, None, True))
+        for n, i in enumerate(
+            self.fork_points(params['anonymous_heads'], commits // 2, commits - 1)
+        ):
+            forks.setdefault(i, []).append((b'default', None, False))
+        for n, i in enumerate(
+            self.fork_points(params['bookmarked_heads'], commits // 2, commits - 1)
+        ):
+            forks.setdefault(i, []).append((b'default', b'bookmark-%d' % n, False))
+        tag_every = commits // (params['tags'] + 1) if params['tags'] else 0
+        subrepo_every = 50
+
+        for i in range(commits):
+            if forks.get(i):
+                # Further forks at the same point are postponed to the next commit:
+                branch, bookmark, merges = forks[i].pop(0)
+                forks.setdefault(i + 1, []).extend(forks.pop(i))
+                line = Line(branch, default.node, default.files, bookmark, merges)
+                lines.append(line)
+                self.commit_changes(line, i)
+                continue
+            to_merge = [line for line in lines if line.merges and line.changed]
+            if params['merge_every'] and i % params['merge_every'] == 0 and to_merge:
+                if self.merge(default, self.rng.choice(to_merge), i):
+                    continue
+            if tag_every and i % tag_every == 0 and i > 0:
+                self.tag(default, i)
+            elif params['subrepos'] and i % subrepo_every == 1:
+                self.update_subrepos(default, i)
+            else:
+                if len(lines) > 1 and self.rng.random() < 0.5:
+                    line = self.rng.choice(lines[1:])
+                else:
+                    line = default
+                self.commit_changes(line, i)
+        return lines
+
+
+def make_repo(dest, **params):
+    """Create a synthetic mercurial repository at dest with the given parameters (see
+    DEFAULTS). Return the number of commits and heads"""
+    params = dict(DEFAULTS, **params)
+    ui = uimod.ui.load()
+    ui.setconfig(b'ui', b'quiet', True)
+    repo = hg.repository(ui, os.fsencode(dest), create=True)
+    with repo.wlock(), repo.lock(), repo.transaction(b'benchmark') as tr:
+        lines = RepoGenerator(repo, params).generate()
+        repo._bookmarks.applychanges(
+            repo, tr, [(line.bookmark, line.node) for line in lines if line.bookmark]
+        )
+    return len(repo), len(repo.heads())
+
+
+def add_arguments(parser):
+    """Add arguments for the parameters of make_repo() to an ArgumentParser"""
+    parser.add_argument('--profile', choices=sorted(PROFILES), default=None)
+    for name, default in sorted(DEFAULTS.items()):
+        parser.add_argument(
+            '--' + name.replace('_', '-'),
+            type=type(default),
+            default=None,
+            help='default: {}'.format(default),
+        )
+
+
+def parse_params(args):
+    """Return the make_repo() parameters from arguments parsed by a parser set up by
+    add_arguments(): the defaults, updated with the profile, updated with any
+    parameters given explicitly"""
+    params = dict(DEFAULTS)
+    if args.profile is not None:
+        params.update(PROFILES[args.profile])
+    for name in DEFAULTS:
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('dest')
+    args = parser.parse_args()
+    if os.path.exists(args.dest):
+        sys.stderr.write("Error: {} already exists\n".format(args.dest))
+        sys.exit(1)
+    commits, heads = make_repo(args.dest, **parse_params(args))
+    print("Created {} with {} commits and {} heads".format(args.dest, commits, heads))
+
+
+if __name__ == '__main__':
+    main()
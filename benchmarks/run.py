@@ -0,0 +1,307 @@
+"""End-to-end conversion benchmarks on synthetic mercurial repositories.
+
+Generates a repository with make_repo.py (cached in the work directory, keyed on its
+parameters), then measures:
+
+    hg_fast_export: hg-fast-export.py on its own, with its output stream parsed and
+                    discarded rather than imported, giving commits/s, blobs/s and
+                    stream bytes/s.
+    exporter:       a full conversion with exporter.py, giving commits/s, and the time
+                    spent in each phase of the conversion from its --report.
+
+along with the peak RSS of each (including child processes). Each is run --repeat
+times and the fastest run is kept. Results are written as JSON, and two results files
+can be compared:
+
+    python run.py [--profile=small|medium|large] [--commits=N ...] [-o results.json]
+    python run.py --compare old.json new.json
+
+Any further arguments after `--` are passed to both exporter.py and hg-fast-export.py,
+for example `-- --hg-hash`.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(here)
+sys.path.insert(0, ROOT)
+import make_repo
+import exporter
+from phasereport import tool_version
+from mercurial import util
+
+EXPORTER = os.path.join(ROOT, 'exporter.py')
+HG_FAST_EXPORT = os.path.join(ROOT, 'fast-export', 'hg-fast-export.py')
+
+# Metrics for which bigger is better when comparing results:
+THROUGHPUT_METRICS = ['commits_per_sec', 'blobs_per_sec', 'stream_bytes_per_sec']
+
+# And for which smaller is better. Others, such as counts, are not judged:
+COST_METRICS = ['wall_time', 'max_rss']
+
+
+def run_measured(cmd, parse_output=None, **kwargs):
+    """Run cmd, passing its output to the function parse_output if given. Return the
+    wall time and the peak RSS in bytes of it and its child processes, raising
+    CalledProcessError if it fails"""
+    start_time = time.time()
+    if parse_output is not None:
+        kwargs['stdout'] = subprocess.PIPE
+    proc = subprocess.Popen(cmd, **kwargs)
+    if parse_output is not None:
+        try:
+            parse_output(proc.stdout)
+        finally:
+            proc.stdout.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_time = time.time() - start_time
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    # ru_maxrss is in bytes on macOS, KiB elsewhere:
+    return wall_time, rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class StreamCounter(object):
+    """Parses a git fast-import stream, counting commits (other than of notes), file
+    contents (blobs or inline) and bytes"""
+
+    def __init__(self):
+        self.commits = 0
+        self.blobs = 0
+        self.bytes = 0
+
+    def __call__(self, stream):
+        readline = stream.readline
+        while True:
+            line = readline()
+            if not line:
+                break
+            self.bytes += len(line)
+            if line.startswith(b'data '):
+                # Skip the data, which may contain anything:
+                size = int(line[5:])
+                while size:
+                    chunk = stream.read(min(size, 2 ** 20))
+                    if not chunk:
+                        break
+                    self.bytes += len(chunk)
+                    size -= len(chunk)
+            elif line.startswith(b'commit ') and not line.startswith(
+                b'commit refs/notes/'
+            ):
+                self.commits += 1
+            elif line == b'blob\n' or (
+                line.startswith(b'M ') and line.split(b' ', 3)[2] == b'inline'
+            ):
+                # hg-fast-export writes file contents inline rather than as blobs:
+                self.blobs += 1
+
+
+def repo_params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def get_repo(workdir, params):
+    """Return the path of a synthetic repo with the given parameters in workdir,
+    generating it if it doesn't exist yet, and the time taken to generate it"""
+    hg_repo = os.path.join(workdir, 'repo-{}.hg'.format(repo_params_hash(params)))
+    if os.path.exists(hg_repo):
+        return hg_repo, None
+    sys.stderr.write("Generating {}...\n".format(hg_repo))
+    start_time = time.time()
+    temp = hg_repo + '.tmp'
+    if os.path.exists(temp):
+        shutil.rmtree(temp)
+    make_repo.make_repo(temp, **params)
+    os.rename(temp, hg_repo)
+    return hg_repo, time.time() - start_time
+
+
+def bench_hg_fast_export(hg_repo, extra_args):
+    """Run hg-fast-export.py on hg_repo, with extra heads given branch overrides as
+    exporter.py would, and parse its output. Return a dict of results"""
+    tempdir = tempfile.mkdtemp()
+    try:
+        subprocess.check_call(['git', 'init', '-q', tempdir])
+        repo = exporter.open_hg_repo(hg_repo)
+        try:
+            overrides = dict(
+                (head['hash'], new_branch_name)
+                for head, new_branch_name in exporter.get_heads_to_rename(repo)
+            )
+        finally:
+            repo.close()
+        overrides_file = exporter.write_branch_overrides(tempdir, overrides)
+        cmd = [sys.executable, HG_FAST_EXPORT, '-r', hg_repo]
+        for option in ['marks', 'mapping', 'heads', 'status']:
+            cmd += ['--' + option, os.path.join(tempdir, 'hg2git-' + option)]
+        cmd += ['--branch-overrides', overrides_file] + extra_args
+        counter = StreamCounter()
+        with open(os.devnull, 'wb') as devnull:
+            wall_time, max_rss = run_measured(
+                cmd, parse_output=counter, cwd=tempdir, stderr=devnull
+            )
+    finally:
+        shutil.rmtree(tempdir)
+    return {
+        'wall_time': wall_time,
+        'max_rss': max_rss,
+        'commits': counter.commits,
+        'blobs': counter.blobs,
+        'stream_bytes': counter.bytes,
+        'commits_per_sec': counter.commits / wall_time,
+        'blobs_per_sec': counter.blobs / wall_time,
+        'stream_bytes_per_sec': counter.bytes / wall_time,
+    }
+
+
+def bench_exporter(hg_repo, n_commits, extra_args):
+    """Convert hg_repo with exporter.py. Return a dict of results"""
+    tempdir = tempfile.mkdtemp()
+    try:
+        mapping_file = os.path.join(tempdir, 'repo_mapping.json')
+        with open(mapping_file, 'w') as f:
+            json.dump({hg_repo: os.path.join(tempdir, 'repo.git')}, f)
+        report_file = os.path.join(tempdir, 'report.json')
+        cmd = [sys.executable, EXPORTER, '--report=' + report_file, mapping_file]
+        with open(os.path.join(tempdir, 'log.txt'), 'wb') as log:
+            wall_time, max_rss = run_measured(cmd + extra_args, stdout=log, stderr=log)
+        with open(report_file) as f:
+            report = json.load(f)
+    finally:
+        shutil.rmtree(tempdir)
+    phases = report['repos'][0]['phases']
+    return {
+        'wall_time': wall_time,
+        'max_rss': max_rss,
+        'commits_per_sec': n_commits / wall_time,
+        'phases': dict((record['phase'], record['wall_time']) for record in phases),
+    }
+
+
+def best(results):
+    """Return the result with the smallest wall time"""
+    return min(results, key=lambda result: result['wall_time'])
+
+
+def run_benchmarks(params, workdir, repeat, extra_args):
+    hg_repo, generation_time = get_repo(workdir, params)
+    repo = make_repo.hg.repository(make_repo.uimod.ui.load(), os.fsencode(hg_repo))
+    n_commits, n_heads = len(repo), len(repo.heads())
+    results = {
+        'tool_version': tool_version(),
+        'mercurial_version': util.version().decode(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': params,
+        'extra_args': extra_args,
+        'repo': {'commits': n_commits, 'heads': n_heads},
+    }
+    if generation_time is not None:
+        results['repo']['generation_time'] = generation_time
+    sys.stderr.write("Running hg-fast-export.py...\n")
+    results['hg_fast_export'] = best(
+        [bench_hg_fast_export(hg_repo, extra_args) for _ in range(repeat)]
+    )
+    sys.stderr.write("Running exporter.py...\n")
+    results['exporter'] = best(
+        [bench_exporter(hg_repo, n_commits, extra_args) for _ in range(repeat)]
+    )
+    return results
+
+
+def flatten(results, prefix=''):
+    """Return a list of (name, value) for the numeric values in nested dicts"""
+    items = []
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            items.extend(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items.append((prefix + key, value))
+    return items
+
+
+def compare(old_file, new_file):
+    """Print the numeric results of two results files side by side, with the relative
+    change and whether it is an improvement"""
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    if old['params'] != new['params'] or old['extra_args'] != new['extra_args']:
+        print("Warning: results are for different benchmark parameters\n")
+    old_values = dict(flatten(old))
+    rows = [('metric', 'old', 'new', 'change', '')]
+    for name, new_value in flatten(new):
+        if name not in old_values or name.startswith('params.'):
+            continue
+        old_value = old_values[name]
+        change = (new_value - old_value) / float(old_value) if old_value else 0.0
+        metric = name.rsplit('.', 1)[-1]
+        bigger_is_better = metric in THROUGHPUT_METRICS
+        judged = bigger_is_better or metric in COST_METRICS or '.phases.' in name
+        if not judged or abs(change) < 0.05:
+            verdict = ''
+        elif (change > 0) == bigger_is_better:
+            verdict = 'better'
+        else:
+            verdict = 'worse'
+        rows.append(
+            (
+                name,
+                '{:.4g}'.format(old_value),
+                '{:.4g}'.format(new_value),
+                '{:+.1%}'.format(change),
+                verdict,
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def main():
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        extra_args = argv[argv.index('--') + 1 :]
+        argv = argv[: argv.index('--')]
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    make_repo.add_arguments(parser)
+    parser.add_argument(
+        '--workdir',
+        default=os.path.join(tempfile.gettempdir(), 'hg-export-benchmarks'),
+        help='directory to cache generated repositories in',
+    )
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('-o', '--output', help='file to write results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    results = run_benchmarks(
+        make_repo.parse_params(args), args.workdir, args.repeat, extra_args
+    )
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,37 @@ import json
 import sys
 import os
 import errno
-from binascii import hexlify
-from tempfile import gettempdir
+from binascii import hexlify, unhexlify
 import shutil
 from collections import defaultdict
 import itertools
 import stat
+import time
+import traceback
+import multiprocessing
+
+# Branch names and bookmarks are stored as UTF-8, make mercurial not convert them to
+# the locale's encoding. Must be set before mercurial is imported:
+os.environ['HGENCODING'] = 'UTF-8'
+from mercurial import context, phases, scmutil
+
+from hgcopy import copy_hg_repo
+import verification
+from phasereport import PhaseRecorder, write_report
 
 here = os.path.dirname(os.path.abspath(__file__))
 FAST_EXPORT_DIR = os.path.join(here, 'fast-export')
+sys.path.insert(0, FAST_EXPORT_DIR)
+from hg2git import setup_repo, get_git_refs
+import export_driver
+import statestore
+
+# Options of hg-fast-export that make a conversion resumable:
+CHECKPOINT_OPTIONS = [
+    '--checkpoint-commits',
+    '--checkpoint-seconds',
+    '--checkpoint-bytes',
+]
 
 def mkdir_p(path):
     try:
@@ -29,26 +51,50 @@ def remove_readonly(func, path, _):
     func(path)
 
 
-def init_git_repo(git_repo):
-    """Make a new git repo in a temporary directory, and return its path"""
-    random_hex = hexlify(os.urandom(16)).decode()
-    temp_repo = os.path.join(
-        gettempdir(), os.path.basename(git_repo) + '-' + random_hex
+def get_temp_git_repo(git_repo, suffix):
+    """Return the path of a temporary directory alongside git_repo, named after it
+    with the given suffix"""
+    git_repo = os.path.normpath(git_repo)
+    return os.path.join(
+        os.path.dirname(git_repo), '.' + os.path.basename(git_repo) + '-' + suffix
     )
+
+def init_git_repo(git_repo, bare=False, temp_repo=None):
+    """Make a new git repo in a temporary directory alongside git_repo, so that it can
+    later be moved into place with publish_git_repo(), and return its path. The
+    directory is temp_repo if given, otherwise a new, randomly named one."""
+    if temp_repo is None:
+        temp_repo = get_temp_git_repo(git_repo, hexlify(os.urandom(16)).decode())
     mkdir_p(temp_repo)
-    subprocess.check_call(['git', 'init', temp_repo])
+    subprocess.check_call(['git', 'init'] + (['--bare'] if bare else []) + [temp_repo])
     subprocess.check_call(['git', 'config', 'core.ignoreCase', 'false'], cwd=temp_repo)
     return temp_repo
 
-def copy_hg_repo(hg_repo):
-    random_hex = hexlify(os.urandom(16)).decode()
-    hg_repo_copy = os.path.join(
-        gettempdir(), os.path.basename(hg_repo) + '-' + random_hex
-    )
-    shutil.copytree(hg_repo, hg_repo_copy)
-    return hg_repo_copy
+def get_git_dir(git_repo):
+    """Return the path of the git directory of git_repo, which may be bare"""
+    dot_git = os.path.join(git_repo, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    return git_repo
 
-def get_heads(hg_repo):
+def publish_git_repo(temp_git_repo, git_repo):
+    """Move the finished git repo temp_git_repo to git_repo with an atomic rename,
+    falling back to a copy if they are on different filesystems"""
+    try:
+        os.rename(temp_git_repo, git_repo)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        shutil.copytree(temp_git_repo, git_repo, symlinks=True)
+        shutil.rmtree(temp_git_repo, onerror=remove_readonly)
+
+def open_hg_repo(hg_repo):
+    """Return a mercurial repository object for the path hg_repo, filtered to visible
+    changesets as seen by the hg command line"""
+    _, repo = setup_repo(hg_repo)
+    return repo.filtered(b'visible')
+
+def get_heads(repo):
     """Return alist of heads, including of closed branches, each in the
     format:
 
@@ -60,36 +106,39 @@ def get_heads(hg_repo):
         'topological': <whether the head is a topological head>,
     }
 
+    repo is a mercurial repository object as returned by open_hg_repo(). Heads are
+    ordered newest revision first, like `hg heads`.
     """
+    topo_heads = set(repo.heads())
 
-    cmd = ['hg', 'heads', '--closed', '--topo', '--template', 'json']
-    output = subprocess.check_output(cmd, cwd=hg_repo)
-    topo_heads = json.loads(output.decode('utf8'))
-
-    cmd = ['hg', 'heads', '--closed', '--template', 'json']
-    output = subprocess.check_output(cmd, cwd=hg_repo)
-    all_heads = json.loads(output.decode('utf8'))
+    all_heads = []
+    for branch in repo.branchmap():
+        all_heads.extend(repo.branchheads(branch, closed=True))
+    all_heads.sort(key=repo.changelog.rev, reverse=True)
 
     results = []
-    for head in all_heads:
+    for node in all_heads:
+        ctx = repo[node]
+        time, offset = ctx.date()
+        bookmarks = ctx.bookmarks()
         results.append(
             {
-                'hash': head['node'],
-                'branch': head['branch'],
-                'timestamp': head['date'][0] + head['date'][1],  # add UTC offset
+                'hash': ctx.hex().decode(),
+                'branch': ctx.branch().decode('utf8'),
+                'timestamp': time + offset,  # add UTC offset
                 # If multiple bookmarks, ignore all but one:
-                'bookmark': head['bookmarks'][0] if head['bookmarks'] else None,
-                'topological': head in topo_heads
+                'bookmark': bookmarks[0].decode('utf8') if bookmarks else None,
+                'topological': node in topo_heads
             }
         )
 
     return results
 
-def fix_branches(hg_repo):
-    """Amend anonymous/bookmarked additional heads on a branch to be on a new branch ,
-    either <branchname>-<n>, or the first bookmark name. Return a dict of commits
-    amended mapping the original commit hash to the amended one"""
-    all_heads = get_heads(hg_repo)
+def get_heads_to_rename(repo):
+    """Return a list of (head, new_branch_name) for anonymous/bookmarked additional
+    heads on a branch that need to be moved to a new branch, either <branchname>-<n>,
+    or the first bookmark name. Heads are dicts as returned by get_heads()"""
+    all_heads = get_heads(repo)
     heads_by_branch = defaultdict(list)
     # Group by branch:
     for head in all_heads:
@@ -97,7 +146,7 @@ def fix_branches(hg_repo):
     # Sort by timestamp, newest first:
     for heads in heads_by_branch.values():
         heads.sort(reverse=True, key=lambda head: head['timestamp'])
-    amended_commits = {}
+    results = []
     for branch, heads in heads_by_branch.items():
         if len(heads) == 1 or all(not head['topological'] for head in heads):
             # No topological heads in this branch, no renaming:
@@ -116,111 +165,792 @@ def fix_branches(hg_repo):
                 new_branch_name = head['bookmark']
             else:
                 new_branch_name = branch + '-%d' % next(counter)
-            # Amend the head to modify its branch name:
-            subprocess.check_call(['hg', 'up', head['hash']], cwd=hg_repo)
-            # Commit must be in draft phase to be able to amend it:
-            subprocess.check_call(
-                ['hg', 'phase', '--draft', '--force', head['hash']], cwd=hg_repo
-            )
-            subprocess.check_call(['hg', 'branch', new_branch_name], cwd=hg_repo)
-            msg = subprocess.check_output(
-                ['hg', 'log', '-r', head['hash'], '--template', '{desc}'], cwd=hg_repo
-            ).rstrip(b'\n')
-            subprocess.check_call(['hg', 'commit', '--amend', '-m', msg], cwd=hg_repo)
-            new_hash = (
-                subprocess.check_output(
-                    ['hg', 'log', '-l', '1', '--template', '{node}\n'], cwd=hg_repo
+            results.append((head, new_branch_name))
+    return results
+
+def fix_branches(hg_repo, heads_to_rename=None):
+    """Amend anonymous/bookmarked additional heads on a branch to be on a new branch ,
+    either <branchname>-<n>, or the first bookmark name. Return a dict of commits
+    amended mapping the original commit hash to the amended one. heads_to_rename, if
+    given, should be as returned by get_heads_to_rename(), otherwise it is computed.
+
+    All amendments are made in a single transaction. The original heads are then
+    stripped, or obsoleted if obsolescence markers are enabled, as `hg commit --amend`
+    would do."""
+    repo = open_hg_repo(hg_repo)
+    try:
+        if heads_to_rename is None:
+            heads_to_rename = get_heads_to_rename(repo)
+        if not heads_to_rename:
+            return {}
+        amended_commits = {}
+        replacements = {}
+        with repo.wlock(), repo.lock(), repo.transaction(b'fix-branches') as tr:
+            for head, new_branch_name in heads_to_rename:
+                # Amend the head to modify its branch name, keeping everything else:
+                old_ctx = repo[head['hash'].encode()]
+                extra = old_ctx.extra().copy()
+                extra[b'branch'] = new_branch_name.encode('utf8')
+                extra[b'amend_source'] = old_ctx.hex()
+                new_ctx = context.metadataonlyctx(
+                    repo,
+                    old_ctx,
+                    text=old_ctx.description(),
+                    user=old_ctx.user(),
+                    date=old_ctx.date(),
+                    extra=extra,
                 )
-                .decode()
-                .rstrip('\n')
-            )
-            amended_commits[head['hash']] = new_hash
-    return amended_commits
-
-def convert(hg_repo_copy, git_repo, fast_export_args, bash):
-    env = os.environ.copy()
-    env['PYTHON'] = sys.executable
-    env['PATH'] = FAST_EXPORT_DIR + os.pathsep + env.get('PATH', '')
-    env['HGENCODING'] = 'UTF-8'
-    subprocess.check_call(
-        [bash, 'hg-fast-export.sh', '-r', hg_repo_copy] + fast_export_args,
-        env=env,
-        cwd=git_repo,
+                new_node = repo.commitctx(new_ctx)
+                replacements[old_ctx.node()] = [new_node]
+                amended_commits[head['hash']] = repo[new_node].hex().decode()
+            # Commits must be in draft phase to be able to replace them:
+            phases.retractboundary(repo, tr, phases.draft, list(replacements))
+            scmutil.cleanupnodes(repo, replacements, b'amend', backup=False)
+        return amended_commits
+    finally:
+        repo.close()
+
+def write_branch_overrides(git_repo, overrides):
+    """Write a branch overrides file for hg-fast-export to the git directory of
+    git_repo, so that it exports each hg commit in the dict overrides on the branch it
+    maps to. Return the path of the file."""
+    overrides_file = os.path.join(get_git_dir(git_repo), 'hg2git-branch-overrides')
+    with open(overrides_file, 'wb') as f:
+        for commit_hash, branch in overrides.items():
+            line = u':{} {}\n'.format(commit_hash, branch)
+            f.write(line.encode('utf8'))
+    return overrides_file
+
+def read_branch_overrides(git_repo):
+    """Return the dict of branch overrides used by the previous conversion of
+    git_repo, or None if it was not converted using branch overrides"""
+    overrides_file = os.path.join(get_git_dir(git_repo), 'hg2git-branch-overrides')
+    if not os.path.exists(overrides_file):
+        return None
+    overrides = {}
+    with open(overrides_file, 'rb') as f:
+        for line in f:
+            commit_hash, branch = line.decode('utf8').rstrip('\n').split(' ', 1)
+            overrides[commit_hash[1:]] = branch
+    return overrides
+
+def get_branch_overrides(repo, heads_to_rename):
+    """Return a dict of branch overrides for a new conversion, giving each head in
+    heads_to_rename, as returned by get_heads_to_rename(), its new branch name.
+
+    The commits leading up to a renamed head along first parents get its new name too,
+    back to the first that is on another hg branch or on the line of a head keeping its
+    name. Otherwise they would be exported on the git branch of their hg branch, which
+    is then left pointing into the renamed line whenever the export stops partway, for
+    example at a checkpoint or after --time-budget."""
+    changelog = repo.changelog
+    renamed = set(head['hash'] for head, _ in heads_to_rename)
+    on_a_line = set()
+
+    def walk_line(head):
+        rev = changelog.rev(unhexlify(head['hash']))
+        branch = changelog.branchinfo(rev)[0]
+        line = []
+        while (
+            rev >= 0
+            and rev not in on_a_line
+            and changelog.branchinfo(rev)[0] == branch
+        ):
+            line.append(rev)
+            on_a_line.add(rev)
+            rev = changelog.parentrevs(rev)[0]
+        return line
+
+    # Heads keeping their name claim their lines first:
+    for head in get_heads(repo):
+        if head['hash'] not in renamed:
+            walk_line(head)
+    overrides = {}
+    for head, new_branch_name in heads_to_rename:
+        for rev in walk_line(head):
+            overrides[hexlify(changelog.node(rev)).decode()] = new_branch_name
+    return overrides
+
+def get_new_branch_overrides(repo, first_new_rev, previous_overrides):
+    """Return a dict of branch overrides for the hg commits from first_new_rev onward,
+    for an incremental conversion in which previous_overrides were used for the
+    earlier commits.
+
+    Each new head, and the new commits leading up to it along first parents, continue
+    the git branch of the previously exported commit they descend from if possible, so
+    that existing git branches only ever move forward. Other new heads stay on their hg
+    branch if get_heads_to_rename() does not rename them and no other head of that
+    branch is already exported under its name, and are otherwise given a new branch
+    name not used by the previous conversion: the bookmark name, or
+    <branchname>-<n>."""
+    changelog = repo.changelog
+    heads = get_heads(repo)
+    needs_renaming = set(head['hash'] for head, _ in get_heads_to_rename(repo))
+    used_names = set(previous_overrides.values())
+    # Names of git branches whose head is still an hg head, which new heads therefore
+    # cannot continue:
+    taken = set()
+    for head in heads:
+        if changelog.rev(unhexlify(head['hash'])) < first_new_rev:
+            taken.add(previous_overrides.get(head['hash'], head['branch']))
+
+    # Walk back along first parents from each new head to the last commit that was
+    # either previously exported or is on the line of a newer head:
+    lines = []
+    on_a_line = set()
+    for head in heads:
+        rev = changelog.rev(unhexlify(head['hash']))
+        line = []
+        while rev >= first_new_rev and rev not in on_a_line:
+            line.append(rev)
+            rev = changelog.parentrevs(rev)[0]
+        if line:
+            on_a_line.update(line)
+            lines.append((head, line, rev))
+
+    overrides = {}
+    names = {}
+    for head, line, base in lines:
+        if not 0 <= base < first_new_rev:
+            continue
+        if repo[base].branch().decode('utf8') != head['branch']:
+            continue
+        base_hash = hexlify(changelog.node(base)).decode()
+        name = previous_overrides.get(base_hash, head['branch'])
+        if name in taken:
+            continue
+        if base_hash not in previous_overrides:
+            # Only a continuation of the previous head of the hg branch stays on it:
+            if any(child.rev() < first_new_rev for child in repo[base].children()):
+                continue
+        taken.add(name)
+        names[head['hash']] = name
+
+    for head, line, base in lines:
+        if head['hash'] in names:
+            continue
+        if head['hash'] not in needs_renaming and head['branch'] not in taken:
+            name = head['branch']
+        else:
+            if head['bookmark'] is not None:
+                candidates = itertools.chain(
+                    [head['bookmark']],
+                    (head['bookmark'] + '-%d' % n for n in itertools.count(1)),
+                )
+            else:
+                candidates = (head['branch'] + '-%d' % n for n in itertools.count(1))
+            for name in candidates:
+                if name not in used_names and name not in taken:
+                    break
+            used_names.add(name)
+        taken.add(name)
+        names[head['hash']] = name
+
+    for head, line, base in lines:
+        if names[head['hash']] != head['branch']:
+            for rev in line:
+                overrides[hexlify(changelog.node(rev)).decode()] = names[head['hash']]
+    return overrides
+
+def convert(hg_repo, git_repo, fast_export_args, bash=None, checkout=True):
+    """Import hg_repo into git_repo with hg-fast-export, in this process using
+    export_driver. If bash is given, hg-fast-export.sh is instead run with it, as in
+    earlier versions. If checkout is True, master is checked out afterwards."""
+    if bash is None:
+        git_dir = os.path.abspath(get_git_dir(git_repo))
+        args = ['-r', hg_repo] + fast_export_args
+        status = export_driver.hg_fast_export(args, git_dir)
+        if status:
+            raise subprocess.CalledProcessError(status, 'hg-fast-export')
+    else:
+        env = os.environ.copy()
+        env['PYTHON'] = sys.executable
+        env['PATH'] = FAST_EXPORT_DIR + os.pathsep + env.get('PATH', '')
+        env['HGENCODING'] = 'UTF-8'
+        subprocess.check_call(
+            [bash, 'hg-fast-export.sh', '-r', hg_repo] + fast_export_args,
+            env=env,
+            cwd=git_repo,
+        )
+    if checkout:
+        subprocess.check_call(['git', 'checkout', 'master'], cwd=git_repo)
+
+def read_marks_file(filename):
+    """Read a marks or mapping file as written by hg-fast-export (lines of the form
+    ':<key> <value>') and return a dict of its contents as strings."""
+    results = {}
+    with open(filename) as f:
+        for line in f:
+            key, value = line.rstrip('\n').split(' ', 1)
+            results[key[1:]] = value
+    return results
+
+def get_exported_commits(git_dir, revs):
+    """Return a dict of the hg revision numbers in revs to the hashes of the git
+    commits hg-fast-export made of them, looked up in its marks file, in which the mark
+    of each commit is its revision number plus one. Only the marks of revs are kept
+    while reading it, or looked up in the binary store of --binary-state."""
+    marks_file = os.path.join(git_dir, 'hg2git-marks')
+    if not os.path.exists(marks_file):
+        marks = statestore.Marks(marks_file + '.bin', key_offset=1)
+        try:
+            return dict((rev, marks[rev].decode()) for rev in revs)
+        finally:
+            marks.close()
+    wanted = dict((':%d' % (rev + 1), rev) for rev in revs)
+    commits = {}
+    with open(marks_file) as f:
+        for line in f:
+            mark, git_hash = line.rstrip('\n').split(' ', 1)
+            if mark in wanted:
+                commits[wanted[mark]] = git_hash
+    return commits
+
+def update_notes(hg_repo, git_repo, amended_commits):
+    """For commits that we amended on the hg side of hg_repo, update the git note for
+    the corresponding commit to point to the original, unamended hg commit. All notes
+    are replaced in a single notes commit made with git fast-import. The git commits
+    are looked up by their revision in hg_repo, in hg-fast-export's marks."""
+    _, repo = setup_repo(hg_repo)
+    try:
+        hg_revs = dict(
+            (amended_hg_hash, repo.changelog.rev(unhexlify(amended_hg_hash)))
+            for amended_hg_hash in amended_commits.values()
+        )
+    finally:
+        repo.close()
+    git_hashes = get_exported_commits(get_git_dir(git_repo), hg_revs.values())
+    committer = subprocess.check_output(
+        ['git', 'var', 'GIT_COMMITTER_IDENT'], cwd=git_repo
     )
-    subprocess.check_call(['git', 'checkout', 'master'], cwd=git_repo)
-
-def update_notes(git_repo, amended_commits):
-    """For commits that we amended on the hg side, update the git note for the
-    corresponding commit to point to the original, unamended hg commit"""
-    cmd = ['git', 'log', '--branches', '--show-notes=hg', '--format=format:%H %N']
-    lines = subprocess.check_output(cmd, cwd=git_repo).decode('utf8').splitlines()
-    # Mapping of amended hg hashes to git hashes, this is what is currently in the
-    # notes:
-    git_hashes = dict([line.strip().split()[::-1] for line in lines if line.strip()])
+    stream = [
+        b'commit refs/notes/hg\n',
+        b'committer ' + committer.rstrip(b'\n') + b'\n',
+        b'data 0\n',
+        b'from refs/notes/hg^0\n',
+    ]
     for orig_hg_hash, amended_hg_hash in amended_commits.items():
-        git_hash = git_hashes[amended_hg_hash]
-        cmd = ['git', 'notes', '--ref', 'hg', 'remove', git_hash]
-        subprocess.check_call(cmd, cwd=git_repo)
-        cmd = ['git', 'notes', '--ref', 'hg', 'add', git_hash, '-m', orig_hg_hash]
-        subprocess.check_call(cmd, cwd=git_repo)
+        git_hash = git_hashes[hg_revs[amended_hg_hash]]
+        note = orig_hg_hash.encode()
+        stream.append(b'N inline ' + git_hash.encode() + b'\n')
+        stream.append(b'data %d\n' % len(note))
+        stream.append(note + b'\n')
+    stream.append(b'\n')
+    proc = subprocess.Popen(
+        ['git', 'fast-import', '--quiet'], stdin=subprocess.PIPE, cwd=git_repo
+    )
+    proc.communicate(b''.join(stream))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, 'git fast-import')
+
+def process_repo(hg_repo, git_repo, fast_export_args, bash, copy_strategy='auto',
+                 amend_heads=False, verify_trees=0, verify_contents=False,
+                 verify_jobs=1, bare=False, incremental=False, recorder=None):
+    """Convert hg_repo to git_repo. Return 'converted', or 'skipped' if the git repo
+    already exists. If incremental is True, an existing git repo is instead updated
+    with update_repo(), unless amend_heads is True, which it does not support.
 
-def process_repo(hg_repo, git_repo, fast_export_args, bash):
+    By default, extra heads are exported on their new branches by passing
+    hg-fast-export a map of branch overrides, reading hg_repo in place. If
+    amend_heads is True, they are instead amended in a temporary copy of hg_repo
+    made with the given copy strategy (see hgcopy.py), which is then converted.
+
+    If --hg-hash is in fast_export_args, the conversion is verified, comparing the file
+    trees of every verify_trees'th commit if nonzero (see verify_conversion()).
+
+    The git repo is built in a temporary directory alongside git_repo, and moved into
+    place once complete. If bare is True, it is a bare repository, otherwise master is
+    checked out. If fast_export_args write checkpoints (and bash is not given), the
+    directory is .<name>-partial, which is kept if the conversion fails, and from
+    whose last checkpoint the next call resumes.
+
+    The resource usage of each phase of the conversion is recorded with recorder, if
+    given, a PhaseRecorder (see phasereport.py)."""
+    if recorder is None:
+        recorder = PhaseRecorder()
     if os.path.exists(git_repo):
+        if incremental and not amend_heads:
+            return update_repo(
+                hg_repo,
+                git_repo,
+                fast_export_args,
+                bash,
+                verify_trees,
+                verify_contents,
+                verify_jobs,
+                recorder=recorder,
+            )
         msg = "git repo {} already exists, skipping.\n"
+        if incremental:
+            msg = "git repo {} already exists, and --amend-heads does not support "
+            msg += "incremental updates, skipping.\n"
         sys.stderr.write(msg.format(git_repo))
-        return
-    temp_git_repo = init_git_repo(git_repo)
-    hg_repo_copy = copy_hg_repo(hg_repo)
+        return 'skipped'
+    with recorder.phase('get_heads'):
+        repo = open_hg_repo(hg_repo)
+        try:
+            heads_to_rename = get_heads_to_rename(repo)
+            if not amend_heads:
+                overrides = get_branch_overrides(repo, heads_to_rename)
+        finally:
+            repo.close()
+    resumable = bash is None and any(
+        arg.split('=', 1)[0] in CHECKPOINT_OPTIONS for arg in fast_export_args
+    )
+    if resumable and os.path.exists(get_temp_git_repo(git_repo, 'partial')):
+        temp_git_repo = get_temp_git_repo(git_repo, 'partial')
+        msg = "Resuming the conversion in {} from its last checkpoint\n"
+        sys.stderr.write(msg.format(temp_git_repo))
+    elif resumable:
+        temp_git_repo = init_git_repo(
+            git_repo, bare, get_temp_git_repo(git_repo, 'partial')
+        )
+    else:
+        temp_git_repo = init_git_repo(git_repo, bare)
+    # The refs of the new repo can be moved freely, which checkpoints may need:
+    fast_export_args = fast_export_args + ['--force-refs']
+    hg_repo_copy = None
     try:
-        amended_commits = fix_branches(hg_repo_copy)
-        convert(hg_repo_copy, temp_git_repo, fast_export_args, bash)
-        if amended_commits and '--hg-hash' in fast_export_args:
-            update_notes(temp_git_repo, amended_commits)
+        if amend_heads:
+            with recorder.phase('copy_hg_repo'):
+                # The copy may share the original's store if there is nothing to amend:
+                hg_repo_copy = copy_hg_repo(
+                    hg_repo, copy_strategy, writable=bool(heads_to_rename)
+                ).path
+            with recorder.phase('fix_branches'):
+                amended_commits = fix_branches(hg_repo_copy, heads_to_rename)
+            with recorder.phase('convert'):
+                convert(hg_repo_copy, temp_git_repo, fast_export_args, bash, not bare)
+            if amended_commits and '--hg-hash' in fast_export_args:
+                with recorder.phase('update_notes'):
+                    update_notes(hg_repo_copy, temp_git_repo, amended_commits)
+        else:
+            overrides_file = write_branch_overrides(temp_git_repo, overrides)
+            args = fast_export_args + ['--branch-overrides', overrides_file]
+            with recorder.phase('convert'):
+                convert(hg_repo, temp_git_repo, args, bash, not bare)
         if '--hg-hash' in fast_export_args:
-            verify_conversion(hg_repo, temp_git_repo)
-        shutil.copytree(temp_git_repo, git_repo)
+            # The tip exported from the amended copy counts its amended revisions,
+            # which the original doesn't have, and --amend-heads can't resume a
+            # conversion stopped by a budget anyway:
+            stop_rev = None if amend_heads else get_exported_tip(temp_git_repo)
+            with recorder.phase('verify_conversion'):
+                verify_conversion(
+                    hg_repo,
+                    temp_git_repo,
+                    verify_trees,
+                    verify_contents,
+                    verify_jobs,
+                    stop_rev=stop_rev,
+                )
+        with recorder.phase('publish'):
+            publish_git_repo(temp_git_repo, git_repo)
+    except BaseException:
+        if resumable and os.path.exists(temp_git_repo):
+            msg = "Keeping the incomplete conversion in {} to resume from, delete it "
+            msg += "to start over\n"
+            sys.stderr.write(msg.format(temp_git_repo))
+            temp_git_repo = None
+        raise
     finally:
-        shutil.rmtree(temp_git_repo, onerror=remove_readonly)
-        shutil.rmtree(hg_repo_copy, onerror=remove_readonly)
+        if temp_git_repo is not None and os.path.exists(temp_git_repo):
+            shutil.rmtree(temp_git_repo, onerror=remove_readonly)
+        if hg_repo_copy is not None:
+            shutil.rmtree(hg_repo_copy, onerror=remove_readonly)
+    return 'converted'
+
+
+def get_exported_tip(git_repo):
+    """Return the number of hg revisions exported to git_repo so far, as recorded in
+    hg-fast-export's state file. This is less than the number of revisions in the hg
+    repository if a run was limited by --time-budget or --max-bytes."""
+    state_file = os.path.join(get_git_dir(git_repo), 'hg2git-state')
+    return int(read_marks_file(state_file)['tip'])
+
+def get_git_head(git_repo):
+    """Return the hash of the commit HEAD points to, or None if it doesn't exist yet"""
+    cmd = ['git', 'rev-parse', '--quiet', '--verify', 'HEAD']
+    try:
+        return subprocess.check_output(cmd, cwd=git_repo).decode().strip()
+    except subprocess.CalledProcessError:
+        return None
+
+def update_repo(hg_repo, git_repo, fast_export_args, bash, verify_trees=0,
+                verify_contents=False, verify_jobs=1, max_revisions=None, repo=None,
+                recorder=None):
+    """Incrementally update git_repo, previously converted from hg_repo with
+    process_repo(), with any hg commits made since. Only new heads are considered for
+    renaming, only new commits are exported, and only new commits are verified. Return
+    'updated', 'up to date', or 'skipped' if git_repo cannot be updated incrementally.
+
+    If max_revisions is given, at most that many new revisions are exported, and
+    calling update_repo() again continues from there. repo may be an already open
+    repository object for hg_repo, as returned by open_hg_repo(), to be used instead of
+    opening it again. It is not closed afterwards.
+
+    The working tree, if any, is updated to the new HEAD, like `git checkout` would,
+    failing if this would overwrite local modifications. The resource usage of each
+    phase is recorded with recorder, if given, a PhaseRecorder."""
+    if recorder is None:
+        recorder = PhaseRecorder()
+    git_dir = get_git_dir(git_repo)
+    state_file = os.path.join(git_dir, 'hg2git-state')
+    previous_overrides = read_branch_overrides(git_repo)
+    if not os.path.exists(state_file) or previous_overrides is None:
+        msg = "git repo {} was not converted by this tool with branch overrides, "
+        msg += "cannot update it incrementally, skipping.\n"
+        sys.stderr.write(msg.format(git_repo))
+        return 'skipped'
+    first_new_rev = get_exported_tip(git_repo)
+    close_repo = repo is None
+    with recorder.phase('get_heads'):
+        if repo is None:
+            repo = open_hg_repo(hg_repo)
+        try:
+            stop_rev = len(repo.unfiltered())
+            if stop_rev <= first_new_rev:
+                sys.stderr.write("git repo {} is up to date.\n".format(git_repo))
+                return 'up to date'
+            if max_revisions is not None:
+                stop_rev = min(stop_rev, first_new_rev + max_revisions)
+            # Overrides of revisions not exported by a previous run limited by
+            # max_revisions are recomputed, so that they reflect any heads added since:
+            changelog = repo.unfiltered().changelog
+            for commit_hash in list(previous_overrides):
+                node = unhexlify(commit_hash)
+                if not changelog.hasnode(node) or changelog.rev(node) >= first_new_rev:
+                    del previous_overrides[commit_hash]
+            overrides = get_new_branch_overrides(
+                repo, first_new_rev, previous_overrides
+            )
+        finally:
+            if close_repo:
+                repo.close()
+    previous_heads = read_marks_file(os.path.join(git_dir, 'hg2git-heads'))
+    previous_heads.update(
+        (name.decode(), sha1.decode())
+        for name, sha1 in get_git_refs('hg2git/unfinished', git_dir).items()
+    )
+    previous_head = get_git_head(git_repo)
+    overrides.update(previous_overrides)
+    overrides_file = write_branch_overrides(git_repo, overrides)
+    args = fast_export_args + ['--branch-overrides', overrides_file]
+    if max_revisions is not None:
+        args += ['-m', str(stop_rev)]
+    with recorder.phase('convert'):
+        convert(hg_repo, git_repo, args, bash, checkout=False)
+    stop_rev = min(stop_rev, get_exported_tip(git_repo))
+    if git_dir != git_repo and previous_head is not None:
+        with recorder.phase('checkout'):
+            # Two-way merge from the previous HEAD, like git checkout:
+            cmd = ['git', 'read-tree', '-m', '-u', previous_head, 'HEAD']
+            subprocess.check_call(cmd, cwd=git_repo)
+    if '--hg-hash' in fast_export_args:
+        # Only commits not reachable from the previous heads, or the commits of lines
+        # the previous run left unfinished, are new:
+        git_revisions = ['--branches', '--glob=' + verification.UNFINISHED_REFS]
+        git_revisions += ['--not'] + list(previous_heads.values())
+        with recorder.phase('verify_conversion'):
+            verify_conversion(
+                hg_repo,
+                git_repo,
+                verify_trees,
+                verify_contents,
+                verify_jobs,
+                start_rev=first_new_rev,
+                stop_rev=stop_rev,
+                git_revisions=git_revisions,
+            )
+    return 'updated'
 
+def verify_conversion(hg_repo, git_repo, tree_sample=0, contents=False, jobs=1,
+                      start_rev=0, stop_rev=None, git_revisions=None):
+    """Check that every hg commit made it into git, and optionally that the file trees
+    of a sample of commits match (see verification.py). If start_rev, stop_rev and
+    git_revisions are given, only hg commits from start_rev up to stop_rev and git
+    commits reachable from git_revisions are checked. Raise VerificationError if
+    not."""
+    mismatches = verification.verify_conversion(
+        hg_repo,
+        git_repo,
+        start_rev=start_rev,
+        stop_rev=stop_rev,
+        git_revisions=git_revisions,
+        tree_sample=tree_sample,
+        contents=contents,
+        jobs=jobs,
+    )
+    if mismatches:
+        msg = "{} mismatches between {} and {}".format(mismatches, hg_repo, git_repo)
+        raise verification.VerificationError(msg)
 
-def list_of_hg_commits(hg_repo):
-    cmd = ['hg', 'log', '--template', '{node}\n']
-    return subprocess.check_output(cmd, cwd=hg_repo).decode('utf8').splitlines()
 
+def available_memory():
+    """Return the memory available for new processes in bytes, or None if it cannot be
+    determined on this platform"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
 
-def get_commit_mapping(git_repo):
-    """return a dict {git_hash: hg_hash} mapping git commit hashes to the corresponding
-    mercurial hashes for a repo that has been converted using hg-fast-export with the
-    --hg-hash option"""
-    cmd = ['git', 'log', '--branches', '--show-notes=hg', '--format=format:%H %N']
-    lines = subprocess.check_output(cmd, cwd=git_repo).decode('utf8').splitlines()
-    return dict([line.strip().split() for line in lines if line.strip()])
 
-def verify_conversion(hg_repo, git_repo):
-    git_to_hg_hashes = get_commit_mapping(git_repo)
-    hg_hashes = set(list_of_hg_commits(hg_repo))
-    hashes_that_made_it = set(git_to_hg_hashes.values())
+def can_start_job(n_running, min_free_memory):
+    """Return whether another conversion may be started alongside n_running others,
+    given the current load average and available memory. Always True if nothing is
+    running, so that progress is guaranteed"""
+    if n_running == 0:
+        return True
     try:
-        assert hg_hashes == hashes_that_made_it
-    except AssertionError:
-        for hg_hash in hg_hashes - hashes_that_made_it:
-            sys.stderr.write('hg hash %s has no corresponding git commit\n' % hg_hash)
-        raise
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load = 0
+    if load > multiprocessing.cpu_count():
+        return False
+    free_memory = available_memory()
+    if free_memory is not None and free_memory < min_free_memory:
+        return False
+    return True
+
+
+def run_job(hg_repo, git_repo, fast_export_args, bash, log_file, **kwargs):
+    """Run process_repo() in a pool worker, with stdout and stderr (including that of
+    all subprocesses) redirected to log_file. Keyword arguments are passed to
+    process_repo(). Return a dict describing the outcome for the summary table and
+    report"""
+    start_time = time.time()
+    recorder = PhaseRecorder()
+    result = {
+        'hg_repo': hg_repo,
+        'git_repo': git_repo,
+        'log_file': log_file,
+        'error': None,
+        'phases': recorder.phases,
+    }
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with open(log_file, 'wb') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            result['status'] = process_repo(
+                hg_repo, git_repo, fast_export_args, bash, recorder=recorder, **kwargs
+            )
+        except Exception as e:
+            traceback.print_exc()
+            result['status'] = 'failed'
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+    result['time'] = time.time() - start_time
+    return result
+
+
+def get_log_files(git_repos, log_dir):
+    """Return a list of log file paths in log_dir, one per git repo, named after the
+    git repos and made unique where their basenames clash"""
+    log_files = []
+    used = set()
+    for git_repo in git_repos:
+        name = os.path.basename(os.path.normpath(git_repo))
+        candidate = name
+        for n in itertools.count(2):
+            if candidate not in used:
+                break
+            candidate = '{}-{}'.format(name, n)
+        used.add(candidate)
+        log_files.append(os.path.join(log_dir, candidate + '.log'))
+    return log_files
+
+
+def process_repos_parallel(repos, fast_export_args, bash, jobs, min_free_memory,
+                           log_dir, **kwargs):
+    """Convert a list of (hg_repo, git_repo) pairs using a pool of up to `jobs` worker
+    processes. A new conversion is only started once the load average and available
+    memory allow it. Keyword arguments are passed to process_repo(). Return a list of
+    result dicts as returned by run_job()"""
+    mkdir_p(log_dir)
+    log_files = get_log_files([git_repo for _, git_repo in repos], log_dir)
+    pending = [
+        (hg_repo, git_repo, fast_export_args, bash, log_file)
+        for (hg_repo, git_repo), log_file in zip(repos, log_files)
+    ]
+    results = []
+    running = []
+    # A fresh process for each repo, so that nothing leaks between conversions:
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    try:
+        while pending or running:
+            for job in running[:]:
+                if job.ready():
+                    running.remove(job)
+                    result = job.get()
+                    results.append(result)
+                    msg = "[{}/{}] {}: {}\n"
+                    sys.stdout.write(
+                        msg.format(
+                            len(results), len(repos), result['git_repo'],
+                            result['status']
+                        )
+                    )
+                    sys.stdout.flush()
+            while (
+                pending
+                and len(running) < jobs
+                and can_start_job(len(running), min_free_memory)
+            ):
+                args = pending.pop(0)
+                msg = "Starting {}, logging to {}\n"
+                sys.stdout.write(msg.format(args[1], args[4]))
+                sys.stdout.flush()
+                running.append(pool.apply_async(run_job, args, kwargs))
+            time.sleep(0.2)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def print_summary(results):
+    """Print a table of the outcome of each conversion, and the errors of any that
+    failed"""
+    rows = [('hg repo', 'git repo', 'status', 'time')]
+    for result in results:
+        rows.append(
+            (
+                result['hg_repo'],
+                result['git_repo'],
+                result['status'],
+                '{:.1f}s'.format(result['time']),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    print('')
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    failed = [result for result in results if result['status'] == 'failed']
+    if failed:
+        print('')
+        print('{} of {} conversions failed:'.format(len(failed), len(results)))
+        for result in failed:
+            print('  {}: {} (see {})'.format(
+                result['git_repo'], result['error'], result['log_file'])
+            )
+
+
+def changelog_stat(repo):
+    """Return the size and modification time of the changelog of an open repository
+    object, which change whenever commits are added to it"""
+    st = os.stat(repo.svfs.join(b'00changelog.i'))
+    return st.st_size, st.st_mtime
+
+def watch_repos(repos, fast_export_args, bash, interval=5, max_revisions=1000,
+                **kwargs):
+    """Convert each (hg_repo, git_repo) in repos that has not been converted yet, and
+    then keep the git repos in sync with their hg repos indefinitely. Each hg repo is
+    kept open, and polled every interval seconds for new commits by checking its
+    changelog's size and modification time. New commits are exported with
+    update_repo(), at most max_revisions of them per repo at a time, taking turns
+    between repos so that a repo with many new commits does not hold up the rest.
+    kwargs are passed to process_repo() and update_repo(). A failed conversion or
+    update is retried the next time its hg repo changes, and an hg repo that can't be
+    opened or polled is retried on the next poll."""
+    update_kwargs = dict(
+        (name, kwargs[name])
+        for name in ['verify_trees', 'verify_contents', 'verify_jobs']
+        if name in kwargs
+    )
+    open_repos = {}
+    last_stat = {}
+    pending = set(hg_repo for hg_repo, git_repo in repos)
+    while True:
+        for hg_repo, git_repo in repos:
+            try:
+                if hg_repo not in open_repos:
+                    open_repos[hg_repo] = open_hg_repo(hg_repo)
+                repo = open_repos[hg_repo]
+                stat = changelog_stat(repo)
+            except Exception:
+                # Missing or unreadable, try opening it again on the next poll:
+                traceback.print_exc()
+                open_repos.pop(hg_repo, None)
+                pending.discard(hg_repo)
+                continue
+            if stat == last_stat.get(hg_repo) and hg_repo not in pending:
+                continue
+            last_stat[hg_repo] = stat
+            pending.discard(hg_repo)
+            repo.unfiltered().invalidate()
+            if not os.path.exists(git_repo):
+                # Not converted yet, or the conversion failed last time:
+                try:
+                    process_repo(hg_repo, git_repo, fast_export_args, bash, **kwargs)
+                except Exception:
+                    traceback.print_exc()
+                continue
+            try:
+                status = update_repo(
+                    hg_repo,
+                    git_repo,
+                    fast_export_args,
+                    bash,
+                    max_revisions=max_revisions,
+                    repo=repo,
+                    **update_kwargs
+                )
+            except Exception:
+                traceback.print_exc()
+                continue
+            if status == 'updated':
+                # There may be more revisions beyond max_revisions, try again next
+                # turn:
+                pending.add(hg_repo)
+        if not pending:
+            time.sleep(interval)
+
+def pop_option(args, name, default=None):
+    """Remove an option of the form --name=value from the list args and return its
+    value, or return default if it is not present. A bare --name returns True."""
+    for i, arg in enumerate(args):
+        if arg == name:
+            del args[i]
+            return True
+        if arg.startswith(name + '='):
+            del args[i]
+            return arg.split('=', 1)[1]
+    return default
 
 
 def main():
-    for i, arg in enumerate(sys.argv[:]):
-        if arg.startswith('--bash'):
-            del sys.argv[i]
-            BASH = arg.split('=', 1)[1]
-            break
-    else:
-        if os.name == 'nt':
-            msg = "Missing --bash command line argument with path to git bash\n"
-            sys.stderr.write(msg)
-            sys.exit(1)
-        BASH = '/bin/bash'
+    BASH = pop_option(sys.argv, '--bash')
+    if BASH is not None:
+        msg = "Warning: --bash is deprecated, conversions no longer need bash\n"
+        sys.stderr.write(msg)
+    JOBS = int(pop_option(sys.argv, '--jobs', 1))
+    MIN_FREE_MEMORY = int(pop_option(sys.argv, '--min-free-memory', 1024)) * 2 ** 20
+    LOG_DIR = pop_option(sys.argv, '--log-dir')
+    WATCH = pop_option(sys.argv, '--watch', False)
+    WATCH_INTERVAL = float(pop_option(sys.argv, '--watch-interval', 5))
+    WATCH_BATCH = int(pop_option(sys.argv, '--watch-batch', 1000))
+    REPORT = pop_option(sys.argv, '--report')
+    options = {
+        'copy_strategy': pop_option(sys.argv, '--copy-strategy', 'auto'),
+        'amend_heads': pop_option(sys.argv, '--amend-heads', False),
+        'verify_trees': int(pop_option(sys.argv, '--verify-trees', 0)),
+        'verify_contents': pop_option(sys.argv, '--verify-contents', False),
+        'verify_jobs': int(pop_option(sys.argv, '--verify-jobs', 1)),
+        'bare': pop_option(sys.argv, '--bare', False),
+        'incremental': pop_option(sys.argv, '--incremental', False),
+    }
     try:
         REPO_MAPPING_FILE = sys.argv[1]
     except IndexError:
@@ -229,6 +959,10 @@ def main():
         sys.exit(1)
 
     fast_export_args = sys.argv[2:]
+    if BASH is not None and '--binary-state' in fast_export_args:
+        msg = "Error: hg-fast-export.sh does not support --binary-state, drop --bash\n"
+        sys.stderr.write(msg)
+        sys.exit(1)
 
     REPO_MAPPING_FILE = os.path.abspath(REPO_MAPPING_FILE)
     basedir = os.path.dirname(REPO_MAPPING_FILE)
@@ -241,15 +975,66 @@ def main():
         if os.path.exists(arg):
             fast_export_args[i] = os.path.abspath(arg)
 
-    for hg_repo, git_repo in repo_mapping.items():
-        process_repo(
-            # Interpret the paths as relative to basedir - will do nothing if they were
-            # already absolute paths:
-            os.path.join(basedir, hg_repo),
-            os.path.join(basedir, git_repo),
-            fast_export_args,
-            BASH
+    # Interpret the paths as relative to basedir - will do nothing if they were
+    # already absolute paths:
+    repos = [
+        (os.path.join(basedir, hg_repo), os.path.join(basedir, git_repo))
+        for hg_repo, git_repo in repo_mapping.items()
+    ]
+
+    if WATCH:
+        if JOBS != 1 or options['amend_heads'] or REPORT is not None:
+            msg = "Error: --watch cannot be used with --jobs, --amend-heads or "
+            msg += "--report\n"
+            sys.stderr.write(msg)
+            sys.exit(1)
+        options['incremental'] = True
+        watch_repos(
+            repos, fast_export_args, BASH, WATCH_INTERVAL, WATCH_BATCH, **options
         )
+        return
+
+    if JOBS == 1:
+        results = []
+        try:
+            for hg_repo, git_repo in repos:
+                recorder = PhaseRecorder()
+                result = {
+                    'hg_repo': hg_repo,
+                    'git_repo': git_repo,
+                    'status': 'failed',
+                    'phases': recorder.phases,
+                }
+                results.append(result)
+                result['status'] = process_repo(
+                    hg_repo,
+                    git_repo,
+                    fast_export_args,
+                    BASH,
+                    recorder=recorder,
+                    **options
+                )
+        finally:
+            if REPORT is not None:
+                write_report(REPORT, results)
+        return
+
+    if LOG_DIR is None:
+        LOG_DIR = os.path.join(basedir, 'hg-export-logs')
+    results = process_repos_parallel(
+        repos,
+        fast_export_args,
+        BASH,
+        JOBS,
+        MIN_FREE_MEMORY,
+        os.path.abspath(LOG_DIR),
+        **options
+    )
+    print_summary(results)
+    if REPORT is not None:
+        write_report(REPORT, results)
+    if any(result['status'] == 'failed' for result in results):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python2
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Python replacement for hg-fast-export.sh.
+
+Runs hg-fast-export.py in this process, writing its output straight into a
+git fast-import subprocess through a large pipe, and keeps the state files in
+GIT_DIR up to date the same way hg-fast-export.sh does. Takes the same
+arguments as hg-fast-export.sh, and can be used as a command or called as
+hg_fast_export() without needing a shell.
+"""
+
+import os
+import sys
+import subprocess
+import threading
+from hg2git import load_cache,get_git_refs
+import statestore
+
+PY2 = sys.version_info.major == 2
+
+if PY2:
+  from Queue import Queue
+else:
+  from queue import Queue
+
+try:
+  import fcntl
+except ImportError:
+  # Windows
+  fcntl = None
+
+PFX='hg2git'
+STATE_FILES=['state','marks','mapping','heads','blobs']
+# Kept as statestore files name.bin with --binary-state, which need no backup
+BINARY_STATE_FILES={'marks':statestore.Marks,'mapping':statestore.Mapping}
+
+# Size of the pipe to git fast-import. hg-fast-export buffers its output
+# itself, see StreamWriter
+PIPE_SIZE=1<<20
+# From linux/fcntl.h
+F_SETPIPE_SZ=1031
+# Written by hg-fast-export's write_checkpoint after each checkpoint, and
+# echoed by git fast-import once it has completed it
+CHECKPOINT_PROGRESS=b'progress hg2git checkpoint '
+
+_hg_fast_export=None
+
+def load_hg_fast_export():
+  """Import hg-fast-export.py, whose name is not a valid module name, once"""
+  global _hg_fast_export
+  if _hg_fast_export is None:
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'hg-fast-export.py')
+    if PY2:
+      import imp
+      _hg_fast_export=imp.load_source('hg_fast_export',path)
+    else:
+      import importlib.util
+      spec=importlib.util.spec_from_file_location('hg_fast_export',path)
+      _hg_fast_export=importlib.util.module_from_spec(spec)
+      spec.loader.exec_module(_hg_fast_export)
+  return _hg_fast_export
+
+def state_file(git_dir,name):
+  return os.path.join(git_dir,'%s-%s' % (PFX,name))
+
+def git_output(args,git_dir=None):
+  env=dict(os.environ)
+  if git_dir is not None:
+    env['GIT_DIR']=git_dir
+  return subprocess.check_output(['git']+args,env=env).decode('utf8').strip()
+
+def git_config(name,git_dir):
+  try:
+    return git_output(['config',name],git_dir)
+  except subprocess.CalledProcessError:
+    # not set
+    return None
+
+def start_fast_import(git_dir,options):
+  """Start git fast-import reading from a pipe, enlarged where possible so
+  that hg-fast-export rarely has to wait for it. With --done, it only updates
+  refs beyond the last checkpoint if hg-fast-export finishes the stream."""
+  cmd=['git','fast-import','--done']+options+[
+    '--export-marks=%s' % state_file(git_dir,'marks.tmp')]
+  env=dict(os.environ,GIT_DIR=git_dir)
+  proc=subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                        env=env)
+  if fcntl is not None and sys.platform.startswith('linux'):
+    try:
+      fcntl.fcntl(proc.stdin.fileno(),F_SETPIPE_SZ,PIPE_SIZE)
+    except (IOError,OSError):
+      # Larger than /proc/sys/fs/pipe-max-size, keep the default
+      pass
+  return proc
+
+def read_marks(git_dir):
+  """Return the lines of the marks file"""
+  marks=state_file(git_dir,'marks')
+  if not os.path.exists(marks):
+    return []
+  with open(marks,'rb') as f:
+    return f.readlines()
+
+def merge_marks(git_dir,old_lines):
+  """Write the marks file as old_lines, its lines before this run, followed
+  by the marks exported by this run so far, dropping consecutive duplicate
+  lines like `cat old new | uniq`"""
+  marks=state_file(git_dir,'marks')
+  last=old_lines[-1] if old_lines else None
+  with open(marks+'.new','wb') as f:
+    f.writelines(old_lines)
+    with open(state_file(git_dir,'marks.tmp'),'rb') as new_marks:
+      for line in new_marks:
+        if line!=last:
+          f.write(line)
+          last=line
+  statestore.replace(marks+'.new',marks)
+
+def import_marks(git_dir):
+  """Add the marks exported by this run to the binary marks store"""
+  marks=statestore.Marks(state_file(git_dir,'marks.bin'),writable=True)
+  try:
+    with open(state_file(git_dir,'marks.tmp'),'rb') as f:
+      marks.import_text(f)
+    marks.commit()
+  finally:
+    marks.close()
+
+def convert_state_files(git_dir):
+  """Convert the text marks and mapping files of earlier runs to binary
+  stores, keeping the text files as backups"""
+  for name,store_class in BINARY_STATE_FILES.items():
+    filename=state_file(git_dir,name)
+    if os.path.exists(filename) and not os.path.exists(filename+'.bin'):
+      store=store_class(filename+'.bin.new',writable=True)
+      try:
+        with open(filename,'rb') as f:
+          store.import_text(f)
+        store.commit()
+      finally:
+        store.close()
+      os.rename(filename+'.bin.new',filename+'.bin')
+      os.rename(filename,filename+'~')
+
+class CheckpointError(Exception):
+  pass
+
+class CheckpointSync(object):
+  """Passes the output of git fast-import on to stdout on a thread. Called by
+  hg-fast-export with the revision of each checkpoint, waits for git
+  fast-import to complete it and then saves the marks and heads, so that a
+  later run can resume from there."""
+
+  def __init__(self,proc,git_dir,binary_state,old_marks):
+    self.git_dir=git_dir
+    self.binary_state=binary_state
+    self.old_marks=old_marks
+    self.checkpoints=Queue()
+    self.thread=threading.Thread(target=self.read,args=(proc.stdout,))
+    self.thread.daemon=True
+    self.thread.start()
+
+  def read(self,output):
+    stdout=sys.stdout if PY2 else sys.stdout.buffer
+    for line in iter(output.readline,b''):
+      if line.startswith(CHECKPOINT_PROGRESS):
+        self.checkpoints.put(int(line[len(CHECKPOINT_PROGRESS):]))
+      else:
+        stdout.write(line)
+        stdout.flush()
+    self.checkpoints.put(None)
+
+  def save_marks(self):
+    if self.binary_state:
+      import_marks(self.git_dir)
+    else:
+      merge_marks(self.git_dir,self.old_marks)
+
+  def __call__(self,rev):
+    if self.checkpoints.get()!=rev:
+      raise CheckpointError(
+        'git fast-import exited before completing the checkpoint at r%d' % rev)
+    self.save_marks()
+    save_heads(self.git_dir)
+
+  def join(self):
+    self.thread.join()
+
+def save_heads(git_dir):
+  """Save the hashes of all branches for incremental imports and sanity
+  checking"""
+  with open(state_file(git_dir,'heads'),'wb') as f:
+    for name,sha1 in get_git_refs('heads',git_dir).items():
+      f.write(b':%s %s\n' % (name,sha1))
+
+def parse_args(args):
+  """Split off the leading options that hg-fast-export.sh handles itself.
+  Returns the repo, options for git fast-import, whether --force was given,
+  whether --binary-state was given and the arguments for hg-fast-export.py"""
+  repo=None
+  gfi_options=[]
+  force=False
+  args=list(args)
+  while args:
+    if args[0] in ['-r','--r','--re','--rep','--repo']:
+      repo=args[1]
+      args=args[2:]
+    elif args[0] in ['--q','--qu','--qui','--quie','--quiet']:
+      gfi_options.append('--quiet')
+      args=args[1:]
+    elif args[0]=='--force':
+      # passed to both git fast-import and hg-fast-export.py
+      gfi_options.append('--force')
+      force=True
+      break
+    else:
+      break
+  binary_state='--binary-state' in args
+  return repo,gfi_options,force,binary_state,args
+
+def hg_fast_export(args,git_dir=None):
+  """Import a mercurial repository into the git repository git_dir (default:
+  that of the current directory) given the arguments of hg-fast-export.sh.
+  Returns the exit status."""
+  if git_dir is None:
+    git_dir=os.path.abspath(git_output(['rev-parse','--git-dir']))
+  repo,gfi_options,force,binary_state,args=parse_args(args)
+
+  if not force and git_config('core.ignoreCase',git_dir)=='true':
+    sys.stderr.write(
+      'Error: The option core.ignoreCase is set to true in the git\n'
+      'repository. This will produce empty changesets for renames that just\n'
+      'change the case of the file name.\n'
+      'Use --force to skip this check or change the option with\n'
+      'git config core.ignoreCase false\n')
+    return 1
+
+  if os.path.exists(state_file(git_dir,'marks.tmp')):
+    # Left by a run that was killed. git fast-import may have updated the
+    # refs at a checkpoint before the heads were saved, but exporting again
+    # from the saved state recreates the same commits.
+    sys.stderr.write('Resuming an interrupted run from its last checkpoint\n')
+    save_heads(git_dir)
+
+  # Make a backup copy of each state file
+  for name in STATE_FILES:
+    if binary_state and name in BINARY_STATE_FILES:
+      continue
+    if os.path.exists(state_file(git_dir,name)):
+      with open(state_file(git_dir,name),'rb') as src:
+        with open(state_file(git_dir,name)+'~','wb') as dst:
+          dst.write(src.read())
+
+  # for convenience: get default repo from state file
+  if repo is None and os.path.exists(state_file(git_dir,'state')):
+    repo=load_cache(state_file(git_dir,'state')).get(b'repo')
+    if repo is not None:
+      repo=repo.decode('utf8')
+      sys.stderr.write('Using last hg repository "%s"\n' % repo)
+  if repo is None:
+    sys.stderr.write('no repo given, use -r flag\n')
+    return 1
+
+  if binary_state:
+    convert_state_files(git_dir)
+    suffix='.bin'
+  else:
+    # make sure we have a marks cache
+    if not os.path.exists(state_file(git_dir,'marks')):
+      open(state_file(git_dir,'marks'),'wb').close()
+    suffix=''
+
+  module=load_hg_fast_export()
+  args=['--repo',repo,
+        '--marks',state_file(git_dir,'marks')+suffix,
+        '--mapping',state_file(git_dir,'mapping')+suffix,
+        '--heads',state_file(git_dir,'heads'),
+        '--status',state_file(git_dir,'state'),
+        '--blobs',state_file(git_dir,'blobs')]+args
+
+  # The text marks file is rewritten at each checkpoint from its old lines
+  old_marks=None if binary_state else read_marks(git_dir)
+  proc=start_fast_import(git_dir,gfi_options)
+  sync=CheckpointSync(proc,git_dir,binary_state,old_marks)
+  saved_stdout=module.stdout_buffer
+  saved_git_dir=os.environ.get('GIT_DIR')
+  status=1
+  try:
+    module.stdout_buffer=proc.stdin
+    module.checkpoint_sync=sync
+    os.environ['GIT_DIR']=git_dir
+    try:
+      status=module.main(args)
+    except SystemExit as e:
+      status=e.code or 0
+    except CheckpointError as e:
+      sys.stderr.write('Error: %s\n' % e)
+  finally:
+    module.stdout_buffer=saved_stdout
+    module.checkpoint_sync=None
+    if saved_git_dir is None:
+      del os.environ['GIT_DIR']
+    else:
+      os.environ['GIT_DIR']=saved_git_dir
+    if status:
+      # Don't let git fast-import update any refs from a partial stream
+      proc.kill()
+    try:
+      proc.stdin.close()
+    except (IOError,OSError):
+      # git fast-import exited early, its exit status says why
+      pass
+    proc.wait()
+    sync.join()
+    if os.path.exists(state_file(git_dir,'marks.tmp')) and status:
+      os.remove(state_file(git_dir,'marks.tmp'))
+  if status or proc.returncode:
+    return 1
+
+  sync.save_marks()
+  os.remove(state_file(git_dir,'marks.tmp'))
+  save_heads(git_dir)
+  return 0
+
+if __name__=='__main__':
+  if sys.argv[1:2] in [['-h'],['--help']]:
+    load_hg_fast_export().main(['--help'])
+  sys.exit(hg_fast_export(sys.argv[1:]))
@@ -3,17 +3,30 @@
 # Copyright (c) 2007, 2008 Rocco Rutte <pdmef@gmx.net> and others.
 # License: MIT <http://www.opensource.org/licenses/mit-license.php>
 
-from mercurial import node
+from mercurial import repoview
 from mercurial.scmutil import revsymbol
 from hg2git import setup_repo,fixup_user,get_branch,get_changeset
-from hg2git import load_cache,save_cache,get_git_sha1,set_default_branch,set_origin_name
+from hg2git import load_cache,save_cache,get_git_refs,set_default_branch,set_origin_name
+from hg2git import clear_caches
 from optparse import OptionParser
+from collections import OrderedDict,deque
 import re
 import sys
 import os
+import hashlib
+import fnmatch
+import threading
+import time
 from binascii import hexlify
 import pluginloader
+import statestore
 PY2 = sys.version_info.major == 2
+
+try:
+  from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+  # Python 2 without the futures backport: no --prefetch
+  ThreadPoolExecutor = None
 if PY2:
   str = unicode
 
@@ -27,13 +40,30 @@ if PY2 and sys.platform == "win32":
 
 # silly regex to catch Signed-off-by lines in log message
 sob_re=re.compile(b'^Signed-[Oo]ff-[Bb]y: (.+)$')
-# insert 'checkpoint' command after this many commits or none at all if 0
-cfg_checkpoint_count=0
 # write some progress message every this many file contents written
 cfg_export_boundary=1000
 
+# first mark used for blobs with --dedup-blobs, well above any revision's mark
+cfg_blob_mark_base=1<<30
+# most bytes of file contents passed to file data filters in one batch
+cfg_filter_batch_bytes=1<<26
+# number of filenodes to remember whether they are binary for
+cfg_binary_cache_size=100000
+
 subrepo_cache={}
 submodule_mappings=None
+# mappings loaded by load_mapping, by file name and format
+loaded_mappings={}
+blob_marks=None
+prefetcher=None
+# Called with the revision after each checkpoint once git fast-import has
+# completed it, to save the marks and heads it exported. Set by
+# export_driver, without which checkpoints cannot be resumed from
+checkpoint_sync=None
+# contents of the files of the revision being exported read by prefetcher
+prefetched={}
+# whether file contents are binary, by filenode, see is_binary
+binary_cache=OrderedDict()
 
 # True if fast export should automatically try to sanitize
 # author/branch/tag names.
@@ -42,66 +72,300 @@ auto_sanitize = None
 stdout_buffer = sys.stdout if PY2 else sys.stdout.buffer
 stderr_buffer = sys.stderr if PY2 else sys.stderr.buffer
 
+class StreamWriter(object):
+  """Buffered writer for the fast-import stream.
+
+  Writes are copied into a preallocated buffer of buffer_size bytes, which is
+  written out in one call when full. Payloads of at least large_size bytes
+  are not copied: the buffer is written out, followed by a memoryview of the
+  payload. With flush_policy 'commit', the buffer is also flushed at the end
+  of each commit, so that git fast-import sees complete commits promptly;
+  with 'size', only when full. Counts the bytes and batches written to the
+  underlying file in bytes_written and writes."""
+
+  def __init__(self,out,buffer_size=1<<20,large_size=1<<16,flush_policy='size'):
+    self.out=out
+    self.buffer=bytearray(buffer_size)
+    self.view=memoryview(self.buffer)
+    self.pos=0
+    self.large_size=min(large_size,buffer_size)
+    self.flush_policy=flush_policy
+    self.bytes_written=0
+    self.writes=0
+
+  def _write_out(self,chunks):
+    self.out.writelines(chunks)
+    self.bytes_written+=sum(len(chunk) for chunk in chunks)
+    self.writes+=1
+
+  def _drain(self,*chunks):
+    if self.pos:
+      chunks=(self.view[:self.pos],)+chunks
+      self.pos=0
+    if chunks:
+      self._write_out(chunks)
+
+  def write(self,data):
+    n=len(data)
+    if n>=self.large_size:
+      self._drain(memoryview(data))
+      return
+    if self.pos+n>len(self.buffer):
+      self._drain()
+    self.buffer[self.pos:self.pos+n]=data
+    self.pos+=n
+
+  def line(self,data=b''):
+    if data:
+      self.write(data)
+    if self.pos==len(self.buffer):
+      self._drain()
+    self.buffer[self.pos]=10 # \n
+    self.pos+=1
+
+  def data(self,payload):
+    """Write a data command with its payload, followed by a newline"""
+    self.line(b'data %d' % len(payload))
+    self.line(payload)
+
+  def end_commit(self):
+    if self.flush_policy=='commit':
+      self.flush()
+
+  def flush(self):
+    self._drain()
+    self.out.flush()
+
+  def tell(self):
+    """Return the number of bytes written so far, including buffered ones"""
+    return self.bytes_written+self.pos
+
+stream=StreamWriter(stdout_buffer)
+
+def last_mark(old_marks):
+  """Return the greatest mark in old_marks, which is keyed on mark-1, or 0"""
+  if isinstance(old_marks,statestore.Marks):
+    return old_marks.last_mark()
+  return max(old_marks)+1 if old_marks else 0
+
+class BlobMarks(object):
+  """References to the file contents already written as blobs with
+  --dedup-blobs, keyed on the hex filenode, or on a hash of the filenode and
+  file name when file data filters may make the contents depend on the name.
+
+  Blobs written by this run are referred to by their mark, those written by
+  previous runs by the git SHA1 of their mark in the marks file. At most
+  max_size references are kept, dropping the least recently used."""
+
+  def __init__(self,old_marks,max_size):
+    self.refs=OrderedDict() # key -> (mark, dataref)
+    self.old_marks=old_marks
+    self.max_size=max_size
+    self.next_mark=max(cfg_blob_mark_base,last_mark(old_marks)+1)
+    self.written=0
+    self.reused=0
+
+  def load(self,filename):
+    for key,mark in load_cache(filename).items():
+      sha1=self.old_marks.get(int(mark)-1)
+      # Blobs whose import failed have no SHA1
+      if sha1 is not None:
+        self.refs[key]=(int(mark),sha1)
+    while len(self.refs)>self.max_size:
+      self.refs.popitem(last=False)
+
+  def save(self,filename):
+    save_cache(filename,
+               OrderedDict((key,mark) for key,(mark,_) in self.refs.items()))
+
+  def get(self,key):
+    ref=self.refs.pop(key,None)
+    if ref is None:
+      return None
+    self.refs[key]=ref
+    self.reused+=1
+    return ref[1]
+
+  def add(self,key):
+    """Allocate a mark for a new blob and return its reference"""
+    mark=self.next_mark
+    self.next_mark+=1
+    self.refs[key]=(mark,b':%d' % mark)
+    if len(self.refs)>self.max_size:
+      self.refs.popitem(last=False)
+    self.written+=1
+    return b':%d' % mark
+
+class Prefetcher(object):
+  """Reads the contents of the files changed by upcoming revisions on a pool
+  of threads, for --prefetch, while the stream is written in revision order.
+
+  Each thread opens the repository itself, as mercurial's repository
+  objects aren't thread safe. Up to lookahead revisions are read ahead, and
+  no further revisions are started while the contents read but not yet
+  used by export_commit exceed max_bytes. The contents of a revision are
+  returned by contents(), which must be called for each revision of revs in
+  order."""
+
+  def __init__(self,repourl,revs,lookahead,threads,max_bytes):
+    self.repourl=repourl
+    self.revs=iter(revs)
+    self.lookahead=lookahead
+    self.max_bytes=max_bytes
+    self.bytes=0
+    self.lock=threading.Lock()
+    self.local=threading.local()
+    self.pending=deque() # (rev, future)
+    self.executor=ThreadPoolExecutor(threads)
+    self._fill()
+
+  def _fill(self):
+    while len(self.pending)<self.lookahead and self.bytes<self.max_bytes:
+      rev=next(self.revs,None)
+      if rev is None:
+        break
+      self.pending.append((rev,self.executor.submit(self._read,rev)))
+
+  def _read(self,rev):
+    if not hasattr(self.local,'repo'):
+      self.local.repo=setup_repo(self.repourl)[1]
+    repo=self.local.repo
+    contents={}
+    size=0
+    try:
+      ctx=repo[rev]
+      man=ctx.manifest()
+      for file in get_changed_files(repo,ctx,man):
+        filenode=man[file]
+        d=repo.file(file).read(filenode)
+        contents[(file,filenode)]=d
+        size+=len(d)
+    except Exception:
+      # Whatever wasn't read (censored files, etc) is read by export_commit
+      pass
+    with self.lock:
+      self.bytes+=size
+    return contents,size
+
+  def contents(self,rev):
+    """Return a dict of (file, filenode) to the contents of the files
+    changed by rev"""
+    expected,future=self.pending.popleft()
+    assert expected==rev
+    contents,size=future.result()
+    with self.lock:
+      self.bytes-=size
+    self._fill()
+    return contents
+
+  def close(self):
+    for _,future in self.pending:
+      future.cancel()
+    self.executor.shutdown()
+
+def read_file(file_ctx):
+  """Return the contents of file_ctx, from prefetched if they are there"""
+  d=prefetched.pop((file_ctx.path(),file_ctx.filenode()),None)
+  if d is None:
+    d=file_ctx.data()
+  return d
+
 def gitmode(flags):
   return b'l' in flags and b'120000' or b'x' in flags and b'100755' or b'100644'
 
 def wr_no_nl(msg=b''):
-  assert isinstance(msg, bytes)
-  if msg:
-    stdout_buffer.write(msg)
+  stream.write(msg)
 
 def wr(msg=b''):
-  wr_no_nl(msg)
-  stdout_buffer.write(b'\n')
-  #map(lambda x: sys.stderr.write('\t[%s]\n' % x),msg.split('\n'))
-
-def checkpoint(count):
-  count=count+1
-  if cfg_checkpoint_count>0 and count%cfg_checkpoint_count==0:
-    stderr_buffer.write(b"Checkpoint after %d commits\n" % count)
-    wr(b'checkpoint')
-    wr()
-  return count
+  stream.line(msg)
+
+class Checkpointer(object):
+  """Decides when to write a checkpoint: after every commits commits, seconds
+  seconds or size bytes of output, whichever comes first, and when the
+  time_budget seconds or max_bytes bytes of output of this run are used up.
+  A limit of 0 means none."""
+
+  def __init__(self,commits=0,seconds=0,size=0,time_budget=0,max_bytes=0):
+    self.commits=commits
+    self.seconds=seconds
+    self.size=size
+    self.time_budget=time_budget
+    self.max_bytes=max_bytes
+    self.start=time.time()
+    self.reset()
+
+  def reset(self):
+    """Start counting towards the next checkpoint"""
+    self.pending=0
+    self.last_time=time.time()
+    self.last_size=stream.tell()
+
+  def commit_done(self):
+    self.pending+=1
+
+  def due(self):
+    if not self.pending:
+      return False
+    return bool((self.commits and self.pending>=self.commits) or
+                (self.seconds and time.time()-self.last_time>=self.seconds) or
+                (self.size and stream.tell()-self.last_size>=self.size))
+
+  def out_of_budget(self):
+    return bool((self.time_budget and
+                 time.time()-self.start>=self.time_budget) or
+                (self.max_bytes and stream.tell()>=self.max_bytes))
+
+def write_checkpoint(rev):
+  """Make git fast-import write out everything before revision rev, and
+  with checkpoint_sync, wait for it to finish and save what it exported"""
+  stderr_buffer.write(b"Checkpoint at hg r%d\n" % rev)
+  wr(b'checkpoint')
+  wr()
+  # Echoed by git fast-import once the checkpoint is complete
+  wr(b'progress hg2git checkpoint %d' % rev)
+  wr()
+  stream.flush()
+  if checkpoint_sync is not None:
+    checkpoint_sync(rev)
 
 def revnum_to_revref(rev, old_marks):
   """Convert an hg revnum to a git-fast-import rev reference (an SHA1
   or a mark)"""
   return old_marks.get(rev) or b':%d' % (rev+1)
 
-def file_mismatch(f1,f2):
-  """See if two revisions of a file are not equal."""
-  return node.hex(f1)!=node.hex(f2)
-
-def split_dict(dleft,dright,l=[],c=[],r=[],match=file_mismatch):
-  """Loop over our repository and find all changed and missing files."""
-  for left in dleft.keys():
-    right=dright.get(left,None)
-    if right==None:
-      # we have the file but our parent hasn't: add to left set
-      l.append(left)
-    elif match(dleft[left],right) or gitmode(dleft.flags(left))!=gitmode(dright.flags(left)):
-      # we have it but checksums mismatch: add to center set
-      c.append(left)
-  for right in dright.keys():
-    left=dleft.get(right,None)
-    if left==None:
-      # if parent has file but we don't: add to right set
-      r.append(right)
-    # change is already handled when comparing child against parent
-  return l,c,r
-
-def get_filechanges(repo,revision,parents,mleft):
-  """Given some repository and revision, find all changed/deleted files."""
+def get_filechanges(repo,parent,mleft):
+  """Find the added, changed and removed files of the manifest mleft
+  relative to the manifest of revision parent, using mercurial's native
+  manifest diff. A file is changed if its contents or mode differ."""
   l,c,r=[],[],[]
-  for p in parents:
-    if p<0: continue
-    mright=revsymbol(repo,b"%d" %p).manifest()
-    l,c,r=split_dict(mleft,mright,l,c,r)
+  mright=revsymbol(repo,b"%d" % parent).manifest()
+  for f,((n1,_),(n2,_)) in mleft.diff(mright).items():
+    if n2 is None:
+      # we have the file but our parent hasn't
+      l.append(f)
+    elif n1 is None:
+      # our parent has the file but we don't
+      r.append(f)
+    else:
+      c.append(f)
   l.sort()
   c.sort()
   r.sort()
   return l,c,r
 
+def get_changed_files(repo,ctx,man):
+  """Return the added and changed files of ctx, with manifest man, relative
+  to its first parent, like export_commit"""
+  parents=[p for p in repo.changelog.parentrevs(ctx.rev()) if p>=0]
+  if len(parents)==0:
+    return man.keys()
+  if len(parents)==1:
+    f=repo.status(parents[0],ctx.node())
+    added,changed=f.added,f.modified
+  else:
+    added,changed,_=get_filechanges(repo,parents[0],man)
+  return added+changed
+
 def get_author(logmessage,committer,authors):
   """As git distincts between author and committer of a patch, try to
   extract author by detecting Signed-off-by lines.
@@ -161,9 +425,15 @@ def refresh_hg_submodule(name,subrepo_info):
 
   # Populate the cache to map mercurial revision to git revision
   if not name in subrepo_cache:
-    subrepo_cache[name]=(load_cache(gitRepoLocation+b"/hg2git-mapping"),
-                         load_cache(gitRepoLocation+b"/hg2git-marks",
-                                    lambda s: int(s)-1))
+    if os.path.exists(gitRepoLocation+b"/hg2git-mapping.bin"):
+      # Converted with --binary-state: look up single entries in the stores
+      subrepo_cache[name]=(
+        statestore.Mapping(gitRepoLocation+b"/hg2git-mapping.bin"),
+        statestore.Marks(gitRepoLocation+b"/hg2git-marks.bin",key_offset=1))
+    else:
+      subrepo_cache[name]=(load_cache(gitRepoLocation+b"/hg2git-mapping"),
+                           load_cache(gitRepoLocation+b"/hg2git-marks",
+                                      lambda s: int(s)-1))
 
   (mapping_cache,marks_cache)=subrepo_cache[name]
   subrepo_hash=subrepo_info[1]
@@ -200,42 +470,197 @@ def refresh_gitmodules(ctx):
     wr(b'data %d' % (len(gitmodules)+1))
     wr(gitmodules)
 
-def export_file_contents(ctx,manifest,files,hgtags,encoding='',plugins={}):
+def git_filename(file,hgtags,encoding=''):
+  """Return the name of file in git, or None if it is not exported"""
+  # Skip .hgtags files. They only get us in trouble.
+  if not hgtags and file == b".hgtags":
+    stderr_buffer.write(b'Skip %s\n' % file)
+    return None
+  if encoding:
+    filename=file.decode(encoding).encode('utf8')
+  else:
+    filename=file
+  if b'.git' in filename.split(b'/'): # Even on Windows, the path separator is / here.
+    stderr_buffer.write(
+      b'Ignoring file %s which cannot be tracked by git\n' % filename
+    )
+    return None
+  return filename
+
+def is_binary(filenode,data):
+  """Return whether data, the contents of filenode, is binary like
+  mercurial's filectx.isbinary(), checking each filenode only once"""
+  binary=binary_cache.pop(filenode,None)
+  if binary is None:
+    binary=b'\0' in data
+  binary_cache[filenode]=binary
+  if len(binary_cache)>cfg_binary_cache_size:
+    binary_cache.popitem(last=False)
+  return binary
+
+class FileDataFilter(object):
+  """A plugin's file_data_batch_filter, called with a list of the file_data
+  dicts of files from one commit, and the predicates it declares, so that it
+  is only passed the files it applies to:
+
+    file_globs  patterns matched against the whole file name in git, with
+                fnmatch (default: all files)
+    max_size    the size in bytes of the largest file (default: no limit)
+    applies_to  'text' or 'binary' to only filter files of that kind, as
+                told by is_binary (default: both)
+
+  from_v1 adapts a plugin's file_data_filter, which is called for every
+  file, one file_data dict at a time."""
+
+  def __init__(self,batch_filter,file_globs=None,max_size=None,applies_to=None):
+    self.batch_filter=batch_filter
+    self.file_globs=None
+    if file_globs is not None:
+      self.file_globs=[g.encode('utf8') if isinstance(g,str) else g
+                       for g in file_globs]
+    self.max_size=max_size
+    if applies_to not in [None,'text','binary']:
+      raise ValueError("applies_to must be 'text' or 'binary', not %r"
+                       % applies_to)
+    self.applies_to=applies_to
+
+  @classmethod
+  def from_plugin(cls,plugin):
+    return cls(plugin.file_data_batch_filter,
+               getattr(plugin,'file_globs',None),
+               getattr(plugin,'max_size',None),
+               getattr(plugin,'applies_to',None))
+
+  @classmethod
+  def from_v1(cls,file_data_filter):
+    def batch_filter(files):
+      for file_data in files:
+        file_data_filter(file_data)
+    return cls(batch_filter)
+
+  def matches_name(self,filename):
+    if self.file_globs is None:
+      return True
+    return any(fnmatch.fnmatchcase(filename,g) for g in self.file_globs)
+
+  def matches_data(self,file_data):
+    if self.max_size is not None and len(file_data['data'])>self.max_size:
+      return False
+    if self.applies_to is not None:
+      return file_data['is_binary']==(self.applies_to=='binary')
+    return True
+
+def filter_file_data(ctx,manifest,files,filters):
+  """Run filters, a list of FileDataFilter, over files, a list of (file,
+  git filename). Yields (file, filename, data) in order, with the filtered
+  name and contents of files that filters apply to, and data None for the
+  others, which are not read. Each filter is called with batches of up to
+  cfg_filter_batch_bytes of contents."""
+  batch=[]
+  size=0
+  for file,filename in files:
+    wanted=[f for f in filters if f.matches_name(filename)]
+    if not wanted:
+      batch.append((file,filename,None))
+      continue
+    file_ctx=ctx.filectx(file)
+    data=read_file(file_ctx)
+    file_data={'filename':filename,'file_ctx':file_ctx,'data':data,
+               'is_binary':is_binary(manifest[file],data)}
+    batch.append((file,file_data,wanted))
+    size+=len(data)
+    if size>=cfg_filter_batch_bytes:
+      for item in run_file_data_filters(batch,filters):
+        yield item
+      batch=[]
+      size=0
+  for item in run_file_data_filters(batch,filters):
+    yield item
+
+def run_file_data_filters(batch,filters):
+  for filter in filters:
+    # Names and is_binary describe the original file, the size is that of
+    # the output of earlier filters
+    files=[file_data for _,file_data,wanted in batch
+           if wanted and filter in wanted and filter.matches_data(file_data)]
+    if files:
+      filter.batch_filter(files)
+  for file,file_data,wanted in batch:
+    if wanted is None:
+      yield file,file_data,None
+    else:
+      yield file,file_data['filename'],file_data['data']
+
+def export_blobs(ctx,manifest,files,hgtags,encoding='',plugins={}):
+  """Write the contents of files not in blob_marks as blobs. Returns a dict
+  of file to its (possibly filtered) name in git and a reference to its
+  contents, for export_file_contents"""
+  filters=plugins and plugins['file_data_filters']
+  names=[]
+  for file in files:
+    filename=git_filename(file,hgtags,encoding)
+    if filename is not None:
+      names.append((file,filename))
+  if filters:
+    names=filter_file_data(ctx,manifest,names,filters)
+  else:
+    names=((file,filename,None) for file,filename in names)
+  refs={}
+  for file,filename,d in names:
+    filenode=manifest[file]
+    if d is not None:
+      # Filtered contents may depend on the file name
+      key=hexlify(hashlib.sha1(filenode+b'\0'+file).digest())
+    else:
+      key=hexlify(filenode)
+    ref=blob_marks.get(key)
+    if ref is None:
+      if d is None:
+        d=read_file(ctx.filectx(file))
+      ref=blob_marks.add(key)
+      wr(b'blob')
+      wr(b'mark %s' % ref)
+      stream.data(d)
+    refs[file]=(filename,ref)
+  return refs
+
+def export_file_contents(ctx,manifest,files,hgtags,encoding='',plugins={},
+                         refs=None):
+  """Write file changes for files, with inline contents, or referring to the
+  blobs in refs as returned by export_blobs if given"""
   count=0
   max=len(files)
   is_submodules_refreshed=False
-  for file in files:
+  contents=None
+  if refs is None:
+    names=[(file,git_filename(file,hgtags,encoding)) for file in files]
+    if plugins and plugins['file_data_filters']:
+      contents=filter_file_data(ctx,manifest,
+                                [n for n in names if n[1] is not None],
+                                plugins['file_data_filters'])
+  for i,file in enumerate(files):
     if not is_submodules_refreshed and (file==b'.hgsub' or file==b'.hgsubstate'):
       is_submodules_refreshed=True
       refresh_gitmodules(ctx)
-    # Skip .hgtags files. They only get us in trouble.
-    if not hgtags and file == b".hgtags":
-      stderr_buffer.write(b'Skip %s\n' % file)
-      continue
-    if encoding:
-      filename=file.decode(encoding).encode('utf8')
+    if refs is not None:
+      if file not in refs:
+        continue
+      filename,ref=refs[file]
+      stream.line(b'M %s %s %s' % (gitmode(manifest.flags(file)),ref,
+                                   strip_leading_slash(filename)))
     else:
-      filename=file
-    if b'.git' in filename.split(b'/'): # Even on Windows, the path separator is / here.
-      stderr_buffer.write(
-        b'Ignoring file %s which cannot be tracked by git\n' % filename
-      )
-      continue
-    file_ctx=ctx.filectx(file)
-    d=file_ctx.data()
-
-    if plugins and plugins['file_data_filters']:
-      file_data = {'filename':filename,'file_ctx':file_ctx,'data':d}
-      for filter in plugins['file_data_filters']:
-        filter(file_data)
-      d=file_data['data']
-      filename=file_data['filename']
-      file_ctx=file_data['file_ctx']
-
-    wr(b'M %s inline %s' % (gitmode(manifest.flags(file)),
-                           strip_leading_slash(filename)))
-    wr(b'data %d' % len(d)) # had some trouble with size()
-    wr(d)
+      filename=names[i][1]
+      if filename is None:
+        continue
+      d=None
+      if contents is not None:
+        _,filename,d=next(contents)
+      if d is None:
+        d=read_file(ctx.filectx(file))
+
+      stream.line(b'M %s inline %s' % (gitmode(manifest.flags(file)),
+                                      strip_leading_slash(filename)))
+      stream.data(d)
     count+=1
     if count%cfg_export_boundary==0:
       stderr_buffer.write(b'Exported %d/%d files\n' % (count,max))
@@ -286,7 +711,7 @@ def strip_leading_slash(filename):
 
 def export_commit(ui,repo,revision,old_marks,max,count,authors,
                   branchesmap,sob,brmap,hgtags,encoding='',fn_encoding='',
-                  plugins={}):
+                  plugins={},branch_overrides={},notes=None):
   def get_branchname(name):
     if name in brmap:
       return brmap[name]
@@ -294,10 +719,16 @@ def export_commit(ui,repo,revision,old_marks,max,count,authors,
     brmap[name]=n
     return n
 
+  global prefetched
+  if prefetcher is not None:
+    prefetched=prefetcher.contents(revision)
+
   (revnode,_,user,(time,timezone),files,desc,branch,_)=get_changeset(ui,repo,revision,authors,encoding)
   if repo[revnode].hidden():
     return count
 
+  if hexlify(revnode) in branch_overrides:
+    branch=get_branch(branch_overrides[hexlify(revnode)])
   branch=get_branchname(branch)
 
   parents = [p for p in repo.changelog.parentrevs(revision) if p >= 0]
@@ -312,6 +743,35 @@ def export_commit(ui,repo,revision,old_marks,max,count,authors,
     author = commit_data['author']
     desc = commit_data['desc']
 
+  ctx=revsymbol(repo, b"%d" % revision)
+  man=ctx.manifest()
+  added,changed,removed,type=[],[],[],''
+
+  if len(parents) == 0:
+    # first revision: feed in full manifest
+    added=man.keys()
+    added.sort()
+    type='full'
+  elif len(parents) == 1:
+    # later non-merge revision: feed in changed manifest
+    # if we have exactly one parent, just take the changes from the
+    # manifest without expensively comparing checksums. The files recorded
+    # in the changeset aren't used instead: nothing guarantees that they
+    # list every file whose manifest entry changed.
+    f=repo.status(parents[0],revnode)
+    added,changed,removed=f.added,f.modified,f.removed
+    type='simple delta'
+  else: # a merge with two parents
+    # later merge revision: fast-import applies the changes to the tree of
+    # the first parent, so only changes relative to it are needed
+    added,changed,removed=get_filechanges(repo,parents[0],man)
+    type='thorough delta'
+
+  # Blobs can't be written within a commit
+  refs=None
+  if blob_marks is not None:
+    refs=export_blobs(ctx,man,added+changed,hgtags,fn_encoding,plugins)
+
   if len(parents)==0 and revision != 0:
     wr(b'reset refs/heads/%s' % branch)
 
@@ -324,31 +784,10 @@ def export_commit(ui,repo,revision,old_marks,max,count,authors,
   wr(desc)
   wr()
 
-  ctx=revsymbol(repo, b"%d" % revision)
-  man=ctx.manifest()
-  added,changed,removed,type=[],[],[],''
-
-  if len(parents) == 0:
-    # first revision: feed in full manifest
-    added=man.keys()
-    added.sort()
-    type='full'
-  else:
+  if len(parents) > 0:
     wr(b'from %s' % revnum_to_revref(parents[0], old_marks))
-    if len(parents) == 1:
-      # later non-merge revision: feed in changed manifest
-      # if we have exactly one parent, just take the changes from the
-      # manifest without expensively comparing checksums
-      f=repo.status(parents[0],revnode)
-      added,changed,removed=f.added,f.modified,f.removed
-      type='simple delta'
-    else: # a merge with two parents
-      wr(b'merge %s' % revnum_to_revref(parents[1], old_marks))
-      # later merge revision: feed in changed manifest
-      # for many files comparing checksums is expensive so only do it for
-      # merges where we really need it due to hg's revlog logic
-      added,changed,removed=get_filechanges(repo,revision,parents,man)
-      type='thorough delta'
+  if len(parents) > 1:
+    wr(b'merge %s' % revnum_to_revref(parents[1], old_marks))
 
   stderr_buffer.write(
     b'%s: Exporting %s revision %d/%d with %d/%d/%d added/changed/removed files\n'
@@ -363,32 +802,73 @@ def export_commit(ui,repo,revision,old_marks,max,count,authors,
       remove_gitmodules(ctx)
     wr(b'D %s' % filename)
 
-  export_file_contents(ctx,man,added,hgtags,fn_encoding,plugins)
-  export_file_contents(ctx,man,changed,hgtags,fn_encoding,plugins)
+  export_file_contents(ctx,man,added+changed,hgtags,fn_encoding,plugins,refs)
   wr()
+  stream.end_commit()
 
-  return checkpoint(count)
-
-def export_note(ui,repo,revision,count,authors,encoding,is_first):
-  (revnode,_,user,(time,timezone),_,_,_,_)=get_changeset(ui,repo,revision,authors,encoding)
-  if repo[revnode].hidden():
-    return count
+  if notes is not None:
+    notes.append((revision,hexlify(revnode)))
 
-  parents = [p for p in repo.changelog.parentrevs(revision) if p >= 0]
+  return count+1
 
+def export_notes(ui,repo,notes,count,authors,encoding,is_first):
+  """Write a single commit to refs/notes/hg adding a note with the hg hash
+  to each commit in notes, a list of (revision, hex node) collected by
+  export_commit. The committer is that of the last revision."""
+  if not notes:
+    return count
+  (_,_,user,(time,timezone),_,_,_,_)=get_changeset(ui,repo,notes[-1][0],authors,encoding)
   wr(b'commit refs/notes/hg')
   wr(b'committer %s %d %s' % (user,time,timezone))
   wr(b'data 0')
   if is_first:
     wr(b'from refs/notes/hg^0')
-  wr(b'N inline :%d' % (revision+1))
-  hg_hash=revsymbol(repo,b"%d" % revision).hex()
-  wr(b'data %d' % (len(hg_hash)))
-  wr_no_nl(hg_hash)
+  for revision,hg_hash in notes:
+    wr(b'N inline :%d' % (revision+1))
+    stream.data(hg_hash)
   wr()
-  return checkpoint(count)
+  stream.end_commit()
+  return count+1
+
+def export_unfinished(repo,old_marks,max,hidden,count):
+  """Point a ref refs/hg2git/unfinished/<hg hash> at each exported commit
+  whose children are all left for a later run (by -m or a budget). No
+  branch may contain such a commit yet, for example the first parent of a
+  merge whose other parent was exported last. Refs left by earlier runs
+  that are no longer needed are deleted."""
+  changelog=repo.changelog
+  exported_child=bytearray(max)
+  later_child=bytearray(max)
+  for rev in range(len(changelog)):
+    if rev in hidden:
+      continue
+    for parent in changelog.parentrevs(rev):
+      if 0<=parent<max:
+        if rev<max:
+          exported_child[parent]=1
+        else:
+          later_child[parent]=1
+  wanted={}
+  for rev in range(max):
+    if later_child[rev] and not exported_child[rev] and rev not in hidden:
+      wanted[hexlify(changelog.node(rev))]=rev
+  for name,rev in sorted(wanted.items()):
+    wr(b'reset refs/hg2git/unfinished/%s' % name)
+    wr(b'from %s' % revnum_to_revref(rev,old_marks))
+    wr()
+    stream.end_commit()
+    count+=1
+  for name in get_git_refs('hg2git/unfinished'):
+    if name not in wanted:
+      # Deletes the ref
+      wr(b'reset refs/hg2git/unfinished/%s' % name)
+      wr(b'from %s' % (b'0'*40))
+      wr()
+      stream.end_commit()
+      count+=1
+  return count
 
-def export_tags(ui,repo,old_marks,mapping_cache,count,authors,tagsmap):
+def export_tags(ui,repo,old_marks,mapping_cache,max,count,authors,tagsmap):
   l=repo.tagslist()
   for tag,node in l:
     # Remap the branch name
@@ -401,6 +881,10 @@ def export_tags(ui,repo,old_marks,mapping_cache,count,authors,tagsmap):
       continue
 
     rev=int(mapping_cache[hexlify(node)])
+    # ignore tags to revisions left for the next run by a budget
+    if rev>=max:
+      stderr_buffer.write(b'Tag %s refers to unexported hg r%d\n' % (tag, rev))
+      continue
 
     ref=revnum_to_revref(rev, old_marks)
     if ref==None:
@@ -412,10 +896,27 @@ def export_tags(ui,repo,old_marks,mapping_cache,count,authors,tagsmap):
     wr(b'reset refs/tags/%s' % tag)
     wr(b'from %s' % ref)
     wr()
-    count=checkpoint(count)
+    stream.end_commit()
+    count+=1
   return count
 
 def load_mapping(name, filename, mapping_is_raw):
+  """Load a mapping file, reusing the mapping already loaded from it by
+  an earlier run in the same process if the file hasn't changed. The
+  returned mapping must not be modified."""
+  if not os.path.exists(filename):
+    sys.stderr.write('Could not open mapping file [%s]\n' % (filename))
+    return {}
+  st=os.stat(filename)
+  key=(os.path.abspath(filename),mapping_is_raw)
+  stamp=(st.st_mtime,st.st_size)
+  if key not in loaded_mappings or loaded_mappings[key][0]!=stamp:
+    loaded_mappings[key]=(stamp,parse_mapping(filename,mapping_is_raw))
+  cache=loaded_mappings[key][1]
+  sys.stderr.write('Loaded %d %s\n' % (len(cache), name))
+  return cache
+
+def parse_mapping(filename, mapping_is_raw):
   raw_regexp=re.compile(b'^([^=]+)[ ]*=[ ]*(.+)$')
   string_regexp=b'"(((\\.)|(\\")|[^"])*)"'
   quoted_regexp=re.compile(b'^'+string_regexp+b'[ ]*=[ ]*'+string_regexp+b'$')
@@ -442,12 +943,8 @@ def load_mapping(name, filename, mapping_is_raw):
             process_unicode_escape_sequences(m.group(5)))
 
   cache={}
-  if not os.path.exists(filename):
-    sys.stderr.write('Could not open mapping file [%s]\n' % (filename))
-    return cache
   f=open(filename,'rb')
   l=0
-  a=0
   for line in f.readlines():
     l+=1
     line=line.strip()
@@ -461,9 +958,29 @@ def load_mapping(name, filename, mapping_is_raw):
       continue
     # put key:value in cache, key without ^:
     cache[m[0]]=m[1]
-    a+=1
   f.close()
-  sys.stderr.write('Loaded %d %s\n' % (a, name))
+  return cache
+
+def load_branch_overrides(filename):
+  """Load a map of hg changeset hashes to the name of the branch they should be
+  exported on, in place of the branch recorded in the changeset. Each line is of
+  the form ':<changeset hash> <branch name>'."""
+  cache={}
+  if not os.path.exists(filename):
+    sys.stderr.write('Could not open branch overrides file [%s]\n' % (filename))
+    return cache
+  f=open(filename,'rb')
+  l=0
+  for line in f.readlines():
+    l+=1
+    # Branch names may contain spaces, so split only once:
+    fields=line.rstrip(b'\n').split(b' ',1)
+    if len(fields)!=2 or fields[0][0:1]!=b':':
+      sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,l))
+      continue
+    cache[fields[0][1:]]=fields[1]
+  f.close()
+  sys.stderr.write('Loaded %d branch overrides\n' % len(cache))
   return cache
 
 def branchtip(repo, heads):
@@ -475,7 +992,7 @@ def branchtip(repo, heads):
       break
   return tip
 
-def verify_heads(ui,repo,cache,force,branchesmap):
+def verify_heads(ui,repo,cache,force,branchesmap,branch_overrides={}):
   branches={}
   for bn, heads in repo.branchmap().iteritems():
     branches[bn] = branchtip(repo, heads)
@@ -483,15 +1000,17 @@ def verify_heads(ui,repo,cache,force,branchesmap):
   l.sort()
 
   # get list of hg's branches to verify, don't take all git has
+  git_heads=get_git_refs()
   for _,_,b in l:
     b=get_branch(b)
     sanitized_name=sanitize_name(b,"branch",branchesmap)
-    sha1=get_git_sha1(sanitized_name)
+    sha1=git_heads.get(sanitized_name)
     c=cache.get(sanitized_name)
     if sha1!=c:
       stderr_buffer.write(
         b'Error: Branch [%s] modified outside hg-fast-export:'
-        b'\n%s (repo) != %s (cache)\n' % (b, b'<None>' if sha1 is None else sha1, c)
+        b'\n%s (repo) != %s (cache)\n'
+        % (b, b'<None>' if sha1 is None else sha1, b'<None>' if c is None else c)
       )
       if not force: return False
 
@@ -499,6 +1018,8 @@ def verify_heads(ui,repo,cache,force,branchesmap):
   t={}
   for h in repo.filtered(b'visible').heads():
     (_,_,_,_,_,_,branch,_)=get_changeset(ui,repo,h)
+    if hexlify(h) in branch_overrides:
+      branch=get_branch(branch_overrides[hexlify(h)])
     if t.get(branch,False):
       stderr_buffer.write(
         b'Error: repository has at least one unnamed head: hg r%d\n'
@@ -509,18 +1030,42 @@ def verify_heads(ui,repo,cache,force,branchesmap):
 
   return True
 
+def get_subrepo_revs(repo,max):
+  """Return the revisions below max whose subrepositories may differ from
+  those of their parents: those introducing a revision of .hgsub or
+  .hgsubstate, and merges, which may combine those of different parents"""
+  revs=set()
+  for path in [b'.hgsub',b'.hgsubstate']:
+    filelog=repo.file(path)
+    for filerev in filelog:
+      revs.add(filelog.linkrev(filerev))
+  if revs:
+    for rev in range(0,max):
+      if repo.changelog.parentrevs(rev)[1]>=0:
+        revs.add(rev)
+  return sorted(rev for rev in revs if rev<max)
+
 def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,
            authors={},branchesmap={},tagsmap={},
            sob=False,force=False,hgtags=False,notes=False,encoding='',fn_encoding='',
-           plugins={}):
+           plugins={},branch_overrides={},dedup_blobs=False,blobsfile=None,
+           blob_cache_size=0,prefetch=0,prefetch_threads=4,prefetch_bytes=1<<28,
+           binary_state=False,checkpoint_commits=0,checkpoint_seconds=0,
+           checkpoint_bytes=0,time_budget=0,max_bytes=0,force_refs=False):
+  global blob_marks,prefetcher
+
   def check_cache(filename, contents):
     if len(contents) == 0:
       sys.stderr.write('Warning: %s does not contain any data, this will probably make an incremental import fail\n' % filename)
 
   _max=int(m)
 
-  old_marks=load_cache(marksfile,lambda s: int(s)-1)
-  mapping_cache=load_cache(mappingfile)
+  if binary_state:
+    old_marks=statestore.Marks(marksfile,writable=True,key_offset=1)
+    mapping_cache=statestore.Mapping(mappingfile,writable=True)
+  else:
+    old_marks=load_cache(marksfile,lambda s: int(s)-1)
+    mapping_cache=load_cache(mappingfile)
   heads_cache=load_cache(headsfile)
   state_cache=load_cache(tipfile)
 
@@ -530,9 +1075,15 @@ def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,
                          (headsfile, state_cache)]:
       check_cache(name, data)
 
+  blob_marks=None
+  if dedup_blobs:
+    blob_marks=BlobMarks(old_marks,blob_cache_size)
+    if blobsfile:
+      blob_marks.load(blobsfile)
+
   ui,repo=setup_repo(repourl)
 
-  if not verify_heads(ui,repo,heads_cache,force,branchesmap):
+  if not verify_heads(ui,repo,heads_cache,force,branchesmap,branch_overrides):
     return 1
 
   try:
@@ -540,51 +1091,112 @@ def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,
   except AttributeError:
     tip=len(repo)
 
-  min=int(state_cache.get('tip',0))
+  min=int(state_cache.get(b'tip',0))
   max=_max
   if _max<0 or max>tip:
     max=tip
 
-  for rev in range(0,max):
-    (revnode,_,_,_,_,_,_,_)=get_changeset(ui,repo,rev,authors)
-    if repo[revnode].hidden():
+  hidden=repoview.filterrevs(repo,b'visible')
+
+  # The mapping of earlier revisions was saved by the last run
+  first_unmapped=min if mapping_cache else 0
+  for rev in range(first_unmapped,max):
+    if rev in hidden:
       continue
-    mapping_cache[hexlify(revnode)] = b"%d" % rev
+    mapping_cache[hexlify(repo.changelog.node(rev))] = b"%d" % rev
 
   if submodule_mappings:
     # Make sure that all mercurial submodules are registered in the submodule-mappings file
-    for rev in range(0,max):
-      ctx=revsymbol(repo,b"%d" % rev)
-      if ctx.hidden():
+    for rev in get_subrepo_revs(repo,max):
+      if rev in hidden:
         continue
-      if ctx.substate:
-        for key in ctx.substate:
-          if ctx.substate[key][2]=='hg' and key not in submodule_mappings:
-            sys.stderr.write("Error: %s not found in submodule-mappings\n" % (key))
-            return 1
+      ctx=revsymbol(repo,b"%d" % rev)
+      for key in ctx.substate:
+        if ctx.substate[key][2]==b'hg' and key not in submodule_mappings:
+          stderr_buffer.write(b"Error: %s not found in submodule-mappings\n" % key)
+          return 1
+
+  def save_state(tip):
+    state_cache[b'tip']=tip
+    state_cache[b'repo']=repourl
+    if binary_state:
+      mapping_cache.commit()
+    else:
+      save_cache(mappingfile,mapping_cache)
+    if blob_marks is not None and blobsfile:
+      blob_marks.save(blobsfile)
+    # After the mapping, so that the mapping covers any tip saved
+    save_cache(tipfile,state_cache)
+
+  if force_refs:
+    # Checkpoints update the refs to wherever their branches last were,
+    # which isn't necessarily an ancestor of where they end up
+    wr(b'feature force')
 
   c=0
   brmap={}
-  for rev in range(min,max):
-    c=export_commit(ui,repo,rev,old_marks,max,c,authors,branchesmap,
-                    sob,brmap,hgtags,encoding,fn_encoding,
-                    plugins)
-  if notes:
+  hg_hashes=[] if notes else None
+  # Whether refs/notes/hg has a commit to add the next notes commit to
+  notes_parent=min != 0
+  checkpointer=Checkpointer(checkpoint_commits,checkpoint_seconds,
+                            checkpoint_bytes,time_budget,max_bytes)
+  if prefetch>0:
+    prefetcher=Prefetcher(repourl,range(min,max),prefetch,prefetch_threads,
+                          prefetch_bytes)
+  try:
     for rev in range(min,max):
-      c=export_note(ui,repo,rev,c,authors, encoding, rev == min and min != 0)
-
-  state_cache['tip']=max
-  state_cache['repo']=repourl
-  save_cache(tipfile,state_cache)
-  save_cache(mappingfile,mapping_cache)
-
-  c=export_tags(ui,repo,old_marks,mapping_cache,c,authors,tagsmap)
+      c=export_commit(ui,repo,rev,old_marks,max,c,authors,branchesmap,
+                      sob,brmap,hgtags,encoding,fn_encoding,
+                      plugins,branch_overrides,hg_hashes)
+      checkpointer.commit_done()
+      if rev+1==max:
+        break
+      if checkpointer.out_of_budget():
+        stderr_buffer.write(
+          b'Budget used up, stopping at hg r%d, run again to continue\n'
+          % (rev+1))
+        max=rev+1
+        break
+      if checkpointer.due():
+        if notes:
+          c=export_notes(ui,repo,hg_hashes,c,authors,encoding,notes_parent)
+          notes_parent=notes_parent or bool(hg_hashes)
+          del hg_hashes[:]
+        write_checkpoint(rev+1)
+        if checkpoint_sync is not None:
+          # git fast-import has saved everything up to here: resume from it
+          save_state(rev+1)
+        checkpointer.reset()
+  finally:
+    if prefetcher is not None:
+      prefetcher.close()
+      prefetcher=None
+  if notes:
+    c=export_notes(ui,repo,hg_hashes,c,authors,encoding,notes_parent)
+
+  save_state(max)
+  if blob_marks is not None:
+    sys.stderr.write('Wrote %d blobs, reused %d\n'
+                     % (blob_marks.written,blob_marks.reused))
+
+  c=export_tags(ui,repo,old_marks,mapping_cache,max,c,authors,tagsmap)
+  c=export_unfinished(repo,old_marks,max,hidden,c)
+  if binary_state:
+    old_marks.close()
+    mapping_cache.close()
+  # Without this, git fast-import started with --done leaves its refs as they
+  # were at the last checkpoint
+  wr(b'done')
 
   sys.stderr.write('Issued %d commands\n' % c)
 
   return 0
 
-if __name__=='__main__':
+def main(argv):
+  """Run hg-fast-export with the given command line arguments, writing the
+  fast-import stream to stdout_buffer. Returns the exit status."""
+  global auto_sanitize,submodule_mappings,subrepo_cache,stream
+
   def bail(parser,opt):
     sys.stderr.write('Error: No %s option given\n' % opt)
     parser.print_help()
@@ -633,14 +1245,67 @@ if __name__=='__main__':
       help="Assume mappings are raw <key>=<value> lines")
   parser.add_option("--filter-contents",dest="filter_contents",
       help="Pipe contents of each exported file through FILTER_CONTENTS <file-path> <hg-hash> <is-binary>")
+  parser.add_option("--filter-process",dest="filter_process",
+      help="Pipe contents of all exported files through one FILTER_PROCESS, "
+      "see plugins/filter_process/README.md")
   parser.add_option("--plugin-path", type="string", dest="pluginpath",
       help="Additional search path for plugins ")
   parser.add_option("--plugin", action="append", type="string", dest="plugins",
       help="Add a plugin with the given init string <name=init>")
   parser.add_option("--subrepo-map", type="string", dest="subrepo_map",
       help="Provide a mapping file between the subrepository name and the submodule name")
-
-  (options,args)=parser.parse_args()
+  parser.add_option("--dedup-blobs",action="store_true",dest="dedup_blobs",
+      default=False,help="Write the contents of each file revision only once, "
+      "as a blob referred to by later commits")
+  parser.add_option("--blobs",dest="blobsfile",
+      help="File to read and write the blobs written with --dedup-blobs, "
+      "so that later runs can refer to them")
+  parser.add_option("--blob-cache-size",type="int",dest="blob_cache_size",
+      default=100000,help="Maximum number of blobs to remember with "
+      "--dedup-blobs (default: 100000)")
+  parser.add_option("--prefetch",type="int",dest="prefetch",default=0,
+      help="Read the files of up to this many revisions ahead on other threads")
+  parser.add_option("--prefetch-threads",type="int",dest="prefetch_threads",
+      default=4,help="Number of threads for --prefetch (default: 4)")
+  parser.add_option("--prefetch-bytes",type="int",dest="prefetch_bytes",
+      default=1<<28,help="Stop reading ahead for --prefetch while this many "
+      "bytes of file contents are waiting to be written (default: 256 MiB)")
+  parser.add_option("--stream-buffer-size", type="int", dest="stream_buffer_size",
+      default=1<<20,help="Size in bytes of the buffer for the output stream")
+  parser.add_option("--flush-policy", type="choice", choices=['size','commit'],
+      dest="flush_policy", default='size',
+      help="Flush the output stream when its buffer is full ('size', the default) or also after every commit ('commit')")
+  parser.add_option("--branch-overrides", type="string", dest="branch_overrides",
+      help="Read a map of hg changeset hashes to the branch to export them on from BRANCH_OVERRIDES")
+  parser.add_option("--checkpoint-commits",type="int",dest="checkpoint_commits",
+      default=0,help="Write a checkpoint after this many commits")
+  parser.add_option("--checkpoint-seconds",type="int",dest="checkpoint_seconds",
+      default=0,help="Write a checkpoint after this many seconds")
+  parser.add_option("--checkpoint-bytes",type="int",dest="checkpoint_bytes",
+      default=0,help="Write a checkpoint after this many bytes of output")
+  parser.add_option("--time-budget",type="int",dest="time_budget",default=0,
+      help="Stop cleanly after the first commit exported once this many "
+      "seconds have passed, leaving the rest for the next run")
+  parser.add_option("--max-bytes",type="int",dest="max_bytes",default=0,
+      help="Stop cleanly after the first commit exported once this many "
+      "bytes have been written, leaving the rest for the next run")
+  parser.add_option("--force-refs",action="store_true",dest="force_refs",
+      default=False,help="Let git fast-import move branches to commits "
+      "that don't descend from their current ones, as if given --force")
+  parser.add_option("--binary-state",action="store_true",dest="binary_state",
+      default=False,help="The marks and mapping files are binary stores "
+      "(see statestore.py) rather than text")
+
+  (options,args)=parser.parse_args(argv)
+
+  # Reset any state left over from a previous run in the same process
+  clear_caches()
+  stream=StreamWriter(stdout_buffer,options.stream_buffer_size,
+                      flush_policy=options.flush_policy)
+  subrepo_cache={}
+  submodule_mappings=None
+  set_default_branch(b'master')
+  set_origin_name(b'')
 
   m=-1
   auto_sanitize = options.auto_sanitize
@@ -651,12 +1316,15 @@ if __name__=='__main__':
   if options.headsfile==None: bail(parser,'--heads')
   if options.statusfile==None: bail(parser,'--status')
   if options.repourl==None: bail(parser,'--repo')
+  if options.prefetch>0 and ThreadPoolExecutor is None:
+    sys.stderr.write('Error: --prefetch requires concurrent.futures\n')
+    return 1
 
   if options.subrepo_map:
       if not os.path.exists(options.subrepo_map):
         sys.stderr.write('Subrepo mapping file not found %s\n'
                          % options.subrepo_map)
-        sys.exit(1)
+        return 1
       submodule_mappings=load_mapping('subrepo mappings',
                                       options.subrepo_map,False)
 
@@ -672,6 +1340,10 @@ if __name__=='__main__':
   if options.tagsfile!=None:
     t=load_mapping('tags', options.tagsfile, options.raw_mappings)
 
+  o={}
+  if options.branch_overrides!=None:
+    o=load_branch_overrides(options.branch_overrides)
+
   if options.default_branch!=None:
     set_default_branch(options.default_branch)
 
@@ -693,9 +1365,15 @@ if __name__=='__main__':
   if options.filter_contents!=None:
     plugins+=['shell_filter_file_contents='+options.filter_contents]
 
+  if options.filter_process!=None:
+    plugins+=['filter_process='+options.filter_process]
+
+  binary_cache.clear()
   plugins_dict={}
   plugins_dict['commit_message_filters']=[]
   plugins_dict['file_data_filters']=[]
+  # Plugins with a close() method, called once the export is done
+  closing=[]
 
   if plugins and options.pluginpath:
     sys.stderr.write('Using additional plugin path: ' + options.pluginpath + '\n')
@@ -706,14 +1384,41 @@ if __name__=='__main__':
     i = pluginloader.get_plugin(name,options.pluginpath)
     sys.stderr.write('Loaded plugin ' + i['name'] + ' from path: ' + i['path'] +' with opts: ' + opts + '\n')
     plugin = pluginloader.load_plugin(i).build_filter(opts)
-    if hasattr(plugin,'file_data_filter') and callable(plugin.file_data_filter):
-      plugins_dict['file_data_filters'].append(plugin.file_data_filter)
+    if (hasattr(plugin,'file_data_batch_filter') and
+        callable(plugin.file_data_batch_filter)):
+      plugins_dict['file_data_filters'].append(FileDataFilter.from_plugin(plugin))
+    elif hasattr(plugin,'file_data_filter') and callable(plugin.file_data_filter):
+      plugins_dict['file_data_filters'].append(
+        FileDataFilter.from_v1(plugin.file_data_filter))
     if hasattr(plugin, 'commit_message_filter') and callable(plugin.commit_message_filter):
       plugins_dict['commit_message_filters'].append(plugin.commit_message_filter)
+    if hasattr(plugin,'close') and callable(plugin.close):
+      closing.append(plugin)
 
-  sys.exit(hg2git(options.repourl,m,options.marksfile,options.mappingfile,
+  try:
+    status=hg2git(options.repourl,m,options.marksfile,options.mappingfile,
                   options.headsfile, options.statusfile,
                   authors=a,branchesmap=b,tagsmap=t,
                   sob=options.sob,force=options.force,hgtags=options.hgtags,
                   notes=options.notes,encoding=encoding,fn_encoding=fn_encoding,
-                  plugins=plugins_dict))
+                  plugins=plugins_dict,branch_overrides=o,
+                  dedup_blobs=options.dedup_blobs,blobsfile=options.blobsfile,
+                  blob_cache_size=options.blob_cache_size,prefetch=options.prefetch,
+                  prefetch_threads=options.prefetch_threads,
+                  prefetch_bytes=options.prefetch_bytes,
+                  binary_state=options.binary_state,
+                  checkpoint_commits=options.checkpoint_commits,
+                  checkpoint_seconds=options.checkpoint_seconds,
+                  checkpoint_bytes=options.checkpoint_bytes,
+                  time_budget=options.time_budget,max_bytes=options.max_bytes,
+                  force_refs=options.force_refs)
+  finally:
+    for plugin in closing:
+      plugin.close()
+  stream.flush()
+  sys.stderr.write('Wrote %d bytes to the output stream in %d writes\n'
+                   % (stream.bytes_written,stream.writes))
+  return status
+
+if __name__=='__main__':
+  sys.exit(main(sys.argv[1:]))
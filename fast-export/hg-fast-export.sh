@@ -25,6 +25,7 @@ SFX_MAPPING="mapping"
 SFX_MARKS="marks"
 SFX_HEADS="heads"
 SFX_STATE="state"
+SFX_BLOBS="blobs"
 GFI_OPTS=""
 
 if [ -z "${PYTHON}" ]; then
@@ -45,7 +46,7 @@ if [ -z "${PYTHON}" ]; then
     exit 1
 fi
 
-USAGE="[--quiet] [-r <repo>] [--force] [-m <max>] [-s] [--hgtags] [-A <file>] [-B <file>] [-T <file>] [-M <name>] [-o <name>] [--hg-hash] [-e <encoding>]"
+USAGE="[--quiet] [-r <repo>] [--force] [-m <max>] [-s] [--hgtags] [-A <file>] [-B <file>] [-T <file>] [-M <name>] [-o <name>] [--hg-hash] [-e <encoding>] [--branch-overrides <file>]"
 LONG_USAGE="Import hg repository <repo> up to either tip or <max>
 If <repo> is omitted, use last hg repository as obtained from state file,
 GIT_DIR/$PFX-$SFX_STATE by default.
@@ -77,8 +78,12 @@ Options:
 	--mappings-are-raw Assume mappings are raw <key>=<value> lines
 	--filter-contents <cmd>  Pipe contents of each exported file through <cmd>
 	                         with <file-path> <hg-hash> <is-binary> as arguments
+	--filter-process <cmd>  Pipe contents of all exported files through one
+	                        long-running <cmd>, see plugins/filter_process
 	--plugin <plugin=init>  Add a plugin with the given init string (repeatable)
 	--plugin-path <plugin-path> Add an additional plugin lookup path
+	--branch-overrides <file> Export the hg changesets listed in <file>, with
+	                          lines ':<hg hash> <branch>', on the given branch
 "
 case "$1" in
     -h|--help)
@@ -143,7 +148,7 @@ if [ ! -z "$IGNORECASEWARN" ]; then
 fi;
 
 # Make a backup copy of each state file
-for i in $SFX_STATE $SFX_MARKS $SFX_MAPPING $SFX_HEADS ; do
+for i in $SFX_STATE $SFX_MARKS $SFX_MAPPING $SFX_HEADS $SFX_BLOBS ; do
     if [ -f "$GIT_DIR/$PFX-$i" ] ; then
 	cp "$GIT_DIR/$PFX-$i" "$GIT_DIR/$PFX-$i~"
     fi
@@ -182,6 +187,7 @@ $(
       --mapping "$GIT_DIR/$PFX-$SFX_MAPPING" \
       --heads "$GIT_DIR/$PFX-$SFX_HEADS" \
       --status "$GIT_DIR/$PFX-$SFX_STATE" \
+      --blobs "$GIT_DIR/$PFX-$SFX_BLOBS" \
       "$@" 3>&- || _e1=$?
     echo $_e1 >&3
   } | \
@@ -208,10 +214,8 @@ cat "$GIT_DIR/$PFX-$SFX_MARKS.old" "$GIT_DIR/$PFX-$SFX_MARKS.tmp" \
 
 # save SHA1s of current heads for incremental imports
 # and connectivity (plus sanity checking)
-for head in `git branch | sed 's#^..##'` ; do
-  id="`git rev-parse refs/heads/$head`"
-  echo ":$head $id"
-done > "$GIT_DIR/$PFX-$SFX_HEADS"
+git for-each-ref --format=':%(refname:strip=2) %(objectname)' refs/heads/ \
+  > "$GIT_DIR/$PFX-$SFX_HEADS"
 
 # check diff with color:
 # ( for i in `find . -type f | grep -v '\.git'` ; do diff -u $i $REPO/$i ; done | cdiff ) | less -r
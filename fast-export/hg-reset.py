@@ -4,7 +4,7 @@
 # License: GPLv2
 
 from mercurial import node
-from hg2git import setup_repo,load_cache,get_changeset,get_git_sha1
+from hg2git import setup_repo,load_cache,get_changeset,get_git_refs
 from optparse import OptionParser
 import sys
 from binascii import hexlify
@@ -41,10 +41,11 @@ def get_branches(ui,repo,heads_cache,marks_cache,mapping_cache,max):
   stale=dict.fromkeys(heads_cache)
   changed=[]
   unchanged=[]
+  git_heads=get_git_refs()
   for node,rev in h:
     _,_,user,(_,_),_,desc,branch,_=get_changeset(ui,repo,rev)
     del stale[branch]
-    git_sha1=get_git_sha1(branch)
+    git_sha1=git_heads.get(branch)
     cache_sha1=marks_cache.get(b"%d" % (int(rev)+1))
     if git_sha1!=None and git_sha1==cache_sha1:
       unchanged.append([branch,cache_sha1,rev,desc.split(b'\n')[0],user])
@@ -6,6 +6,7 @@
 from mercurial import hg,util,ui,templatefilters
 from mercurial import error as hgerror
 from mercurial.scmutil import revsymbol,binnode
+from collections import OrderedDict
 
 import re
 import os
@@ -27,14 +28,26 @@ origin_name=b''
 user_re=re.compile(b'([^<]+) (<[^>]*>)$')
 # silly regex to clean out user names
 user_clean_re=re.compile(b'^["]([^"]+)["]$')
+# number of changesets get_changeset keeps parsed
+cfg_changeset_cache_size=10000
+
+# fixup_user results by user after mapping, get_branch results by name,
+# and parsed changesets by node and encoding
+user_cache={}
+branch_cache={}
+changeset_cache=OrderedDict()
 
 def set_default_branch(name):
   global cfg_master
   cfg_master = name.encode('utf8') if not isinstance(name, bytes) else name
+  branch_cache.clear()
+  changeset_cache.clear()
 
 def set_origin_name(name):
   global origin_name
   origin_name = name
+  branch_cache.clear()
+  changeset_cache.clear()
 
 def setup_repo(url):
   try:
@@ -52,6 +65,12 @@ def fixup_user(user,authors):
     # if we have an authors table, try to get mapping
     # by defaulting to the current value of 'user'
     user=authors.get(user,user)
+  fixed=user_cache.get(user)
+  if fixed is None:
+    fixed=user_cache[user]=_fixup_user(user)
+  return fixed
+
+def _fixup_user(user):
   name,mail,m=b'',b'',user_re.match(user)
   if m==None:
     # if we don't have 'Name <mail>' syntax, extract name
@@ -72,6 +91,12 @@ def fixup_user(user,authors):
   return b'%s %s' % (name,mail)
 
 def get_branch(name):
+  branch=branch_cache.get(name)
+  if branch is None:
+    branch=branch_cache[name]=_get_branch(name)
+  return branch
+
+def _get_branch(name):
   # 'HEAD' is the result of a bug in mutt's cvs->hg conversion,
   # other CVS imports may need it, too
   if name==b'HEAD' or name==b'default' or name==b'':
@@ -80,23 +105,60 @@ def get_branch(name):
     return origin_name + b'/' + name
   return name
 
-def get_changeset(ui,repo,revision,authors={},encoding=''):
-  # Starting with Mercurial 4.6 lookup no longer accepts raw hashes
-  # for lookups. Work around it by changing our behaviour depending on
-  # how it fails
-  try:
-    node=repo.lookup(revision)
-  except (TypeError, hgerror.ProgrammingError):
-    node=binnode(revsymbol(repo, b"%d" % revision)) # We were given a numeric rev
-  except hgerror.RepoLookupError:
-    node=revision # We got a raw hash
+class Changeset(object):
+  """The fields of a changeset used by the export, with the user (before
+  fixup_user) and description decoded, and the timezone and branch
+  formatted for git"""
+  __slots__=('node','manifest','user','date','files','desc','branch','extra')
+
+  def __init__(self,node,manifest,user,date,files,desc,branch,extra):
+    self.node=node
+    self.manifest=manifest
+    self.user=user
+    self.date=date
+    self.files=files
+    self.desc=desc
+    self.branch=branch
+    self.extra=extra
+
+def read_changeset(repo,node,encoding=''):
   (manifest,user,(time,timezone),files,desc,extra)=repo.changelog.read(node)
   if encoding:
     user=user.decode(encoding).encode('utf8')
     desc=desc.decode(encoding).encode('utf8')
   tz=b"%+03d%02d" % (-timezone // 3600, ((-timezone % 3600) // 60))
   branch=get_branch(extra.get(b'branch', b'master'))
-  return (node,manifest,fixup_user(user,authors),(time,tz),files,desc,branch,extra)
+  return Changeset(node,manifest,user,(time,tz),files,desc,branch,extra)
+
+def clear_caches():
+  """Forget the changesets, users and branches seen, before exporting
+  another repository in the same process"""
+  user_cache.clear()
+  branch_cache.clear()
+  changeset_cache.clear()
+
+def get_changeset(ui,repo,revision,authors={},encoding=''):
+  if isinstance(revision,int):
+    node=repo.changelog.node(revision)
+  else:
+    # Starting with Mercurial 4.6 lookup no longer accepts raw hashes
+    # for lookups. Work around it by changing our behaviour depending on
+    # how it fails
+    try:
+      node=repo.lookup(revision)
+    except (TypeError, hgerror.ProgrammingError):
+      node=binnode(revsymbol(repo, b"%d" % revision)) # We were given a numeric rev
+    except hgerror.RepoLookupError:
+      node=revision # We got a raw hash
+  key=(node,encoding)
+  cs=changeset_cache.pop(key,None)
+  if cs is None:
+    cs=read_changeset(repo,node,encoding)
+  changeset_cache[key]=cs
+  if len(changeset_cache)>cfg_changeset_cache_size:
+    changeset_cache.popitem(last=False)
+  return (cs.node,cs.manifest,fixup_user(cs.user,authors),cs.date,cs.files,
+          cs.desc,cs.branch,cs.extra)
 
 def mangle_key(key):
   return key
@@ -128,13 +190,18 @@ def save_cache(filename,cache):
     f.write(b':%s %s\n' % (key, value))
   f.close()
 
-def get_git_sha1(name,type='heads'):
-  try:
-    # use git-rev-parse to support packed refs
-    ref="refs/%s/%s" % (type,name.decode('utf8'))
-    l=subprocess.check_output(["git", "rev-parse", "--verify", "--quiet", ref])
-    if l == None or len(l) == 0:
-      return None
-    return l[0:40]
-  except subprocess.CalledProcessError:
-    return None
+def get_git_refs(type='heads',git_dir=None):
+  """Return a dict of the names of all refs under refs/<type>/ to their
+  SHA1, read with a single git for-each-ref rather than a git rev-parse per
+  ref. Callers take one snapshot and look up every branch in it."""
+  env=None
+  if git_dir is not None:
+    env=dict(os.environ,GIT_DIR=git_dir)
+  prefix="refs/%s/" % type
+  output=subprocess.check_output(
+    ["git","for-each-ref","--format=%(objectname) %(refname)",prefix],env=env)
+  refs={}
+  for line in output.splitlines():
+    sha1,ref=line.split(b' ',1)
+    refs[ref[len(prefix):]]=sha1
+  return refs
@@ -2,10 +2,12 @@ def build_filter(args):
     return Filter(args)
 
 class Filter():
+    # Only called for text files
+    applies_to = 'text'
+
     def __init__(self, args):
         pass
 
-    def file_data_filter(self,file_data):
-        file_ctx = file_data['file_ctx']
-        if not file_ctx.isbinary():
+    def file_data_batch_filter(self,files):
+        for file_data in files:
             file_data['data'] = file_data['data'].replace(b'\r\n', b'\n')
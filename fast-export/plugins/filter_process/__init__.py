@@ -0,0 +1,106 @@
+#Pipe contents of all exported files through one long-running FILTER_PROCESS, see README.md
+import subprocess
+import shlex
+import sys
+from mercurial import node
+
+# Largest payload of a pkt-line, as in git
+MAX_PACKET_DATA = 65516
+FLUSH = b'0000'
+
+def build_filter(args):
+    return Filter(args)
+
+def packet(data):
+    return b'%04x' % (len(data) + 4) + data
+
+class FilterProcessError(Exception):
+    pass
+
+class Filter:
+    def __init__(self, args):
+        self.filter_process = shlex.split(args)
+        try:
+            self.proc = subprocess.Popen(self.filter_process, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except:
+            sys.stderr.write('Starting filter-process %s:\n' % self.filter_process)
+            raise
+        self.handshake()
+
+    def handshake(self):
+        self.write_list([b'hg-fast-export-filter-client', b'version=1'])
+        self.proc.stdin.flush()
+        if self.read_list() != [b'hg-fast-export-filter-server', b'version=1']:
+            raise FilterProcessError('%s does not support the hg-fast-export filter protocol version 1' % self.filter_process)
+        self.write_list([b'capability=filter'])
+        self.proc.stdin.flush()
+        if b'capability=filter' not in self.read_list():
+            raise FilterProcessError('%s does not have the filter capability' % self.filter_process)
+
+    def write_list(self, lines):
+        self.proc.stdin.writelines([packet(line + b'\n') for line in lines] + [FLUSH])
+
+    def write_data(self, data):
+        view = memoryview(data)
+        packets = []
+        for i in range(0, len(data), MAX_PACKET_DATA):
+            chunk = view[i:i + MAX_PACKET_DATA]
+            packets.append(b'%04x' % (len(chunk) + 4))
+            packets.append(chunk)
+        packets.append(FLUSH)
+        self.proc.stdin.writelines(packets)
+
+    def read_exactly(self, n):
+        data = self.proc.stdout.read(n)
+        if len(data) != n:
+            raise FilterProcessError('filter-process %s exited' % self.filter_process)
+        return data
+
+    def read_packet(self):
+        """Return the payload of the next packet, or None for a flush"""
+        length = int(self.read_exactly(4), 16)
+        if length == 0:
+            return None
+        return self.read_exactly(length - 4)
+
+    def read_list(self):
+        lines = []
+        line = self.read_packet()
+        while line is not None:
+            lines.append(line.rstrip(b'\n'))
+            line = self.read_packet()
+        return lines
+
+    def read_data(self):
+        chunks = []
+        chunk = self.read_packet()
+        while chunk is not None:
+            chunks.append(chunk)
+            chunk = self.read_packet()
+        return b''.join(chunks)
+
+    def file_data_batch_filter(self, files):
+        for file_data in files:
+            self.filter_file(file_data)
+
+    def filter_file(self, file_data):
+        filename = file_data['filename']
+        self.write_list([b'command=filter',
+                         b'pathname=' + filename,
+                         b'filenode=' + node.hex(file_data['file_ctx'].filenode()),
+                         b'binary=' + (b'1' if file_data['is_binary'] else b'0')])
+        self.write_data(file_data['data'])
+        self.proc.stdin.flush()
+        status = self.read_list()
+        if b'status=success' in status:
+            data = self.read_data()
+            # An empty list keeps the status
+            status = self.read_list() or status
+        if b'status=success' not in status:
+            raise FilterProcessError('filter-process %s failed on %s: %s' % (
+                self.filter_process, filename.decode('utf8', 'replace'), b' '.join(status).decode('utf8', 'replace')))
+        file_data['data'] = data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
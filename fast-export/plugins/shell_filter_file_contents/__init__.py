@@ -11,11 +11,15 @@ class Filter:
     def __init__(self, args):
         self.filter_contents = shlex.split(args)
 
-    def file_data_filter(self,file_data):
+    def file_data_batch_filter(self,files):
+        for file_data in files:
+            self.filter_file(file_data)
+
+    def filter_file(self,file_data):
         d = file_data['data']
         file_ctx = file_data['file_ctx']
         filename = file_data['filename']
-        filter_cmd = self.filter_contents + [filename, node.hex(file_ctx.filenode()), '1' if file_ctx.isbinary() else '0']
+        filter_cmd = self.filter_contents + [filename, node.hex(file_ctx.filenode()), '1' if file_data['is_binary'] else '0']
         try:
             filter_proc = subprocess.Popen(filter_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
             d, _ = filter_proc.communicate(d)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python2
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Binary stores of fixed-width records, used in place of the marks and
+mapping text files with --binary-state.
+
+A store file starts with a header:
+
+  magic       8 bytes  the kind of store, see Marks and Mapping
+  key size    4 bytes
+  value size  4 bytes
+  sorted      8 bytes  number of records, from the start, sorted by key
+  committed   8 bytes  number of records in the store
+
+followed by the records, each a key and a value. Keys are compared as
+bytes, so numbers are stored big-endian. The sorted records are looked up
+by bisecting the memory-mapped file. Records after them were appended by
+later runs: they are kept in a dict, and take precedence over sorted
+records with the same key.
+
+Appended records only become part of the store once commit() has written
+them to disk and then updated the committed count in the header, so a
+crash in between leaves the store as it was; the partial records are
+dropped when it is next opened for writing. Once the appended records
+outnumber a quarter of the sorted ones, commit() merges them into a new,
+fully sorted file, which atomically replaces the store.
+
+Run as a command to convert between stores and the text format:
+
+  statestore.py export STORE [TEXTFILE]
+  statestore.py import marks|mapping TEXTFILE STORE
+"""
+
+import os
+import sys
+import mmap
+import struct
+from binascii import hexlify,unhexlify
+
+HEADER=struct.Struct('>8sIIQQ')
+
+def replace(src,dst):
+  """os.replace, which Python 2 lacks"""
+  if hasattr(os,'replace'):
+    os.replace(src,dst)
+  else:
+    if os.path.exists(dst):
+      os.remove(dst)
+    os.rename(src,dst)
+
+class RecordStore(object):
+  """A store of records with keys of key_size bytes and values of value_size
+  bytes, see the module docstring. Created empty if path doesn't exist and
+  writable is set."""
+
+  def __init__(self,path,magic,key_size,value_size,writable=False):
+    self.path=path
+    self.magic=magic
+    self.key_size=key_size
+    self.record_size=key_size+value_size
+    self.writable=writable
+    if writable and not os.path.exists(path):
+      self._write_sorted(path,[])
+    self._open()
+
+  def _open(self):
+    self.file=open(self.path,'r+b' if self.writable else 'rb')
+    header=self.file.read(HEADER.size)
+    if len(header)<HEADER.size:
+      raise ValueError('%s is not a state store' % self.path)
+    magic,key_size,value_size,self.sorted,self.committed=HEADER.unpack(header)
+    if (magic!=self.magic or key_size!=self.key_size or
+        key_size+value_size!=self.record_size):
+      raise ValueError('%s is not a state store of this kind' % self.path)
+    end=HEADER.size+self.committed*self.record_size
+    if self.writable and os.path.getsize(self.path)>end:
+      # Records appended but never committed
+      self.file.truncate(end)
+    self.map=mmap.mmap(self.file.fileno(),end,access=mmap.ACCESS_READ)
+    self.appended={}
+    for i in range(self.sorted,self.committed):
+      key,value=self._record(i)
+      self.appended[key]=value
+    self.pending=[]
+
+  def _record(self,i):
+    offset=HEADER.size+i*self.record_size
+    record=self.map[offset:offset+self.record_size]
+    return record[:self.key_size],record[self.key_size:]
+
+  def _find(self,key):
+    lo,hi=0,self.sorted
+    while lo<hi:
+      mid=(lo+hi)//2
+      offset=HEADER.size+mid*self.record_size
+      if self.map[offset:offset+self.key_size]<key:
+        lo=mid+1
+      else:
+        hi=mid
+    if lo<self.sorted:
+      k,value=self._record(lo)
+      if k==key:
+        return value
+    return None
+
+  def get(self,key):
+    value=self.appended.get(key)
+    if value is None:
+      value=self._find(key)
+    return value
+
+  def append(self,key,value):
+    self.pending.append(key+value)
+    self.appended[key]=value
+
+  def last_key(self):
+    """Return the greatest key, or None if the store is empty"""
+    keys=list(self.appended)
+    if self.sorted:
+      keys.append(self._record(self.sorted-1)[0])
+    return max(keys) if keys else None
+
+  def __len__(self):
+    """The number of records, counting those replaced by later ones"""
+    return self.sorted+len(self.appended)
+
+  def items(self):
+    """Iterate over the (key, value) records in order of key"""
+    appended=sorted(self.appended.items())
+    j=0
+    for i in range(self.sorted):
+      key,value=self._record(i)
+      while j<len(appended) and appended[j][0]<key:
+        yield appended[j]
+        j+=1
+      if j<len(appended) and appended[j][0]==key:
+        continue
+      yield key,value
+    for item in appended[j:]:
+      yield item
+
+  def commit(self):
+    if not self.pending:
+      return
+    self.file.seek(HEADER.size+self.committed*self.record_size)
+    self.file.write(b''.join(self.pending))
+    self._sync()
+    self.committed+=len(self.pending)
+    self.pending=[]
+    self.file.seek(0)
+    self.file.write(HEADER.pack(self.magic,self.key_size,
+                                self.record_size-self.key_size,
+                                self.sorted,self.committed))
+    self._sync()
+    if len(self.appended)>self.sorted//4:
+      self.compact()
+
+  def _sync(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+
+  def _write_sorted(self,path,items):
+    """Write the records in items, sorted by key without duplicates, as a
+    new store at path"""
+    tmp=path+'.tmp'
+    self._write_file(tmp,items)
+    replace(tmp,path)
+
+  def _write_file(self,path,items):
+    with open(path,'wb') as f:
+      f.write(HEADER.pack(self.magic,self.key_size,
+                          self.record_size-self.key_size,0,0))
+      n=0
+      for key,value in items:
+        f.write(key+value)
+        n+=1
+      f.seek(0)
+      f.write(HEADER.pack(self.magic,self.key_size,
+                          self.record_size-self.key_size,n,n))
+      f.flush()
+      os.fsync(f.fileno())
+
+  def compact(self):
+    # The store is only replaced once it is closed, as Windows can't replace
+    # a file that is open or mapped
+    tmp=self.path+'.tmp'
+    self._write_file(tmp,self.items())
+    self.close()
+    replace(tmp,self.path)
+    self._open()
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+class Marks(object):
+  """The marks of git fast-import: mark numbers to git SHA1s in hex. Marks
+  are looked up as key-key_offset, so that key_offset=1 looks them up by
+  hg revision like hg-fast-export's old_marks."""
+  magic=b'HG2GMRK1'
+  number=struct.Struct('>Q')
+
+  def __init__(self,path,writable=False,key_offset=0):
+    self.store=RecordStore(path,self.magic,8,20,writable)
+    self.key_offset=key_offset
+
+  def get(self,key,default=None):
+    sha1=self.store.get(self.number.pack(key+self.key_offset))
+    return hexlify(sha1) if sha1 is not None else default
+
+  def __getitem__(self,key):
+    sha1=self.get(key)
+    if sha1 is None:
+      raise KeyError(key)
+    return sha1
+
+  def __contains__(self,key):
+    return self.get(key) is not None
+
+  def __len__(self):
+    return len(self.store)
+
+  def last_mark(self):
+    key=self.store.last_key()
+    return self.number.unpack(key)[0] if key is not None else 0
+
+  def import_text(self,f):
+    """Add the marks of a file exported by git fast-import, skipping those
+    already in the store"""
+    for line in f:
+      fields=line.split()
+      if len(fields)==2 and fields[0][0:1]==b':':
+        key=self.number.pack(int(fields[0][1:]))
+        sha1=unhexlify(fields[1])
+        if self.store.get(key)!=sha1:
+          self.store.append(key,sha1)
+
+  def text_items(self):
+    for key,sha1 in self.store.items():
+      yield b'%d' % self.number.unpack(key)[0],hexlify(sha1)
+
+  def commit(self):
+    self.store.commit()
+
+  def close(self):
+    self.store.close()
+
+class Mapping(object):
+  """hg-fast-export's mapping of hg changeset hashes to revision numbers,
+  as a dict of hex hash to decimal revision like the text mapping file"""
+  magic=b'HG2GMAP1'
+  number=struct.Struct('>I')
+
+  def __init__(self,path,writable=False):
+    self.store=RecordStore(path,self.magic,20,4,writable)
+
+  def get(self,hex_node,default=None):
+    rev=self.store.get(unhexlify(hex_node))
+    return b'%d' % self.number.unpack(rev)[0] if rev is not None else default
+
+  def __getitem__(self,hex_node):
+    rev=self.get(hex_node)
+    if rev is None:
+      raise KeyError(hex_node)
+    return rev
+
+  def __setitem__(self,hex_node,rev):
+    if self.get(hex_node)==rev:
+      return
+    self.store.append(unhexlify(hex_node),self.number.pack(int(rev)))
+
+  def __contains__(self,hex_node):
+    return self.get(hex_node) is not None
+
+  def __len__(self):
+    return len(self.store)
+
+  def import_text(self,f):
+    """Add the entries of a text mapping file"""
+    for line in f:
+      fields=line.split()
+      if len(fields)==2 and fields[0][0:1]==b':':
+        self[fields[0][1:]]=fields[1]
+
+  def text_items(self):
+    for node,rev in self.store.items():
+      yield hexlify(node),b'%d' % self.number.unpack(rev)[0]
+
+  def commit(self):
+    self.store.commit()
+
+  def close(self):
+    self.store.close()
+
+KINDS={b'marks':Marks,b'mapping':Mapping}
+
+def open_store(path,writable=False):
+  """Open the store at path as Marks or Mapping, according to its magic"""
+  with open(path,'rb') as f:
+    magic=f.read(8)
+  for store_class in KINDS.values():
+    if store_class.magic==magic:
+      return store_class(path,writable)
+  raise ValueError('%s is not a state store' % path)
+
+def export_text(store,f):
+  """Write store in the format of the text state files"""
+  for key,value in store.text_items():
+    f.write(b':%s %s\n' % (key,value))
+
+def main(argv):
+  if len(argv) in [2,3] and argv[0]=='export':
+    store=open_store(argv[1])
+    try:
+      if len(argv)==3:
+        with open(argv[2],'wb') as f:
+          export_text(store,f)
+      else:
+        out=sys.stdout if sys.version_info.major==2 else sys.stdout.buffer
+        export_text(store,out)
+    finally:
+      store.close()
+    return 0
+  if len(argv)==4 and argv[0]=='import' and argv[1].encode() in KINDS:
+    store=KINDS[argv[1].encode()](argv[3],writable=True)
+    try:
+      with open(argv[2],'rb') as f:
+        store.import_text(f)
+      store.commit()
+    finally:
+      store.close()
+    return 0
+  sys.stderr.write(__doc__[__doc__.index('  statestore.py'):])
+  return 2
+
+if __name__=='__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,176 @@
+"""Strategies for making a temporary copy of a mercurial repository.
+
+Only the .hg directory is copied, the copy has no working copy files (its working copy
+parent is the null revision). Available strategies, from cheapest to most expensive:
+
+    share:    `hg share -U`, sharing the store of the original repository. Commits
+              made in the copy are written to the original repository's store, so this
+              is only used if the copy will not be modified.
+    reflink:  Copy-on-write clone of each file (FICLONE), on filesystems that support it
+              (btrfs, XFS, ...). Requires the copy to be on the same filesystem.
+    hardlink: `hg clone -U`, which hardlinks the store files on the same filesystem.
+              Mercurial breaks the hardlink of any store file it writes to.
+    copy:     A plain copy of the .hg directory.
+"""
+import os
+import sys
+import shutil
+import subprocess
+from binascii import hexlify
+from tempfile import gettempdir
+
+try:
+    import fcntl
+except ImportError:
+    # Windows:
+    fcntl = None
+
+STRATEGIES = ['share', 'reflink', 'hardlink', 'copy']
+
+# From linux/fs.h:
+FICLONE = 0x40049409
+
+# Files in .hg describing the working copy. Leaving out the dirstate makes the copy's
+# working copy parent the null revision, consistent with it having no files:
+WORKING_COPY_FILES = ['dirstate', 'undo.dirstate', 'undo.backup.dirstate']
+
+
+class CopyResult(object):
+    """The outcome of copying a repository: its path, the strategy used, and the number
+    of bytes actually copied and shared with the original"""
+
+    def __init__(self, path, strategy, bytes_copied, bytes_shared):
+        self.path = path
+        self.strategy = strategy
+        self.bytes_copied = bytes_copied
+        self.bytes_shared = bytes_shared
+
+    def __repr__(self):
+        msg = "<CopyResult {} via {}: {} bytes copied, {} bytes shared>"
+        return msg.format(
+            self.path, self.strategy, self.bytes_copied, self.bytes_shared
+        )
+
+
+def temp_path(hg_repo, same_filesystem):
+    """Return a new temporary path for a copy of hg_repo. If same_filesystem, and the
+    temporary directory is on a different filesystem to hg_repo, the path is a hidden
+    directory alongside hg_repo instead"""
+    random_hex = hexlify(os.urandom(16)).decode()
+    name = os.path.basename(os.path.normpath(hg_repo)) + '-' + random_hex
+    tempdir = gettempdir()
+    parent = os.path.dirname(os.path.abspath(hg_repo))
+    if same_filesystem and os.stat(tempdir).st_dev != os.stat(parent).st_dev:
+        return os.path.join(parent, '.' + name)
+    return os.path.join(tempdir, name)
+
+
+def reflink_file(src, dst):
+    """Make dst a copy-on-write clone of src, raising OSError if not supported"""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def reflink_supported(hg_repo, dest_dir):
+    """Return whether files in hg_repo can be reflinked into dest_dir"""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    probe = os.path.join(dest_dir, '.reflink-probe-' + hexlify(os.urandom(8)).decode())
+    try:
+        reflink_file(os.path.join(hg_repo, '.hg', 'requires'), probe)
+    except (IOError, OSError):
+        return False
+    finally:
+        if os.path.exists(probe):
+            os.unlink(probe)
+    return True
+
+
+def hardlink_supported(hg_repo, dest_dir):
+    """Return whether files in hg_repo can be hardlinked into dest_dir"""
+    probe = os.path.join(dest_dir, '.hardlink-probe-' + hexlify(os.urandom(8)).decode())
+    try:
+        os.link(os.path.join(hg_repo, '.hg', 'requires'), probe)
+    except (AttributeError, IOError, OSError):
+        return False
+    os.unlink(probe)
+    return True
+
+
+def copy_dot_hg(hg_repo, dest, copy_function):
+    """Copy the .hg directory of hg_repo to dest/.hg with the given function, leaving
+    out the working copy state"""
+    os.mkdir(dest)
+    shutil.copytree(
+        os.path.join(hg_repo, '.hg'),
+        os.path.join(dest, '.hg'),
+        ignore=lambda directory, names: [n for n in names if n in WORKING_COPY_FILES],
+        copy_function=copy_function,
+    )
+
+
+def count_bytes(dest, strategy):
+    """Return (bytes_copied, bytes_shared) for the files of a copy made with the given
+    strategy. Hardlinked files count as shared, as do all files of a reflinked copy,
+    since their data blocks are shared until written to"""
+    bytes_copied = bytes_shared = 0
+    for dirpath, _, filenames in os.walk(os.path.join(dest, '.hg')):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if strategy == 'reflink' or st.st_nlink > 1:
+                bytes_shared += st.st_size
+            else:
+                bytes_copied += st.st_size
+    return bytes_copied, bytes_shared
+
+
+def choose_strategy(hg_repo, writable):
+    """Return the cheapest strategy that is safe and supported for copying hg_repo. If
+    writable, the copy will be modified, which rules out sharing the store"""
+    if not writable:
+        return 'share'
+    dest_dir = os.path.dirname(temp_path(hg_repo, same_filesystem=True))
+    if reflink_supported(hg_repo, dest_dir):
+        return 'reflink'
+    if hardlink_supported(hg_repo, dest_dir):
+        return 'hardlink'
+    return 'copy'
+
+
+def copy_hg_repo(hg_repo, strategy='auto', writable=True):
+    """Make a temporary copy of hg_repo without a working copy, using the given
+    strategy, or the cheapest safe one if strategy is 'auto'. Return a CopyResult."""
+    if strategy == 'auto':
+        strategy = choose_strategy(hg_repo, writable)
+    elif strategy not in STRATEGIES:
+        msg = "Unknown copy strategy {!r}, must be one of: auto, {}"
+        raise ValueError(msg.format(strategy, ', '.join(STRATEGIES)))
+    elif strategy == 'share' and writable:
+        raise ValueError("Copy strategy 'share' cannot be used for a writable copy")
+
+    dest = temp_path(hg_repo, same_filesystem=strategy in ['reflink', 'hardlink'])
+    if strategy == 'reflink' and not reflink_supported(hg_repo, os.path.dirname(dest)):
+        msg = "Copy strategy 'reflink' is not supported for copying {} to {}"
+        raise ValueError(msg.format(hg_repo, os.path.dirname(dest)))
+    try:
+        if strategy == 'share':
+            cmd = ['hg', '--config', 'extensions.share=', 'share', '-U', hg_repo, dest]
+            subprocess.check_call(cmd)
+        elif strategy == 'hardlink':
+            subprocess.check_call(['hg', 'clone', '-U', hg_repo, dest])
+        elif strategy == 'reflink':
+            copy_dot_hg(hg_repo, dest, reflink_file)
+        else:
+            copy_dot_hg(hg_repo, dest, shutil.copy2)
+    except Exception:
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        raise
+
+    bytes_copied, bytes_shared = count_bytes(dest, strategy)
+    result = CopyResult(dest, strategy, bytes_copied, bytes_shared)
+    msg = "Copied {} to {} via {}: {} bytes copied, {} bytes shared\n"
+    sys.stderr.write(msg.format(hg_repo, dest, strategy, bytes_copied, bytes_shared))
+    return result
@@ -0,0 +1,211 @@
+"""Timing and resource usage of each phase of a repository conversion, and reports of
+them across many conversions in JSON or CSV format.
+
+For each phase, the wall time, the CPU time of this process (which runs
+hg-fast-export) and of its child processes (git fast-import, etc.), and the bytes read
+from and written to disk are recorded, along with the peak memory use of this process,
+max_rss, and of its child processes, children_max_rss. The latter is only available for
+child processes as a whole, as the largest resident set size of any child process
+finished so far, and the former is the peak since this process started. Either is only
+the peak of a phase if it was reached during the phase, so it is recorded as None
+otherwise: the phase used no more than an earlier phase, or an earlier conversion in
+the same process. The resource module is not available on
+Windows, where memory use is reported as None and bytes read and written as zero.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows:
+    resource = None
+
+FIELDS = [
+    'wall_time',
+    'user_time',
+    'system_time',
+    'max_rss',
+    'children_max_rss',
+    'read_bytes',
+    'written_bytes',
+]
+
+# Peaks since this process started, rather than totals:
+PEAK_FIELDS = ['max_rss', 'children_max_rss']
+
+# getrusage() counts blocks of 512 bytes:
+BLOCK_SIZE = 512
+
+
+def usage():
+    """Return a dict of the current totals of each of FIELDS for this process and its
+    finished child processes"""
+    times = os.times()
+    snapshot = {
+        'wall_time': time.time(),
+        'user_time': times[0] + times[2],
+        'system_time': times[1] + times[3],
+        'max_rss': 0,
+        'children_max_rss': 0,
+        'read_bytes': 0,
+        'written_bytes': 0,
+    }
+    if resource is not None:
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in bytes on macOS, KiB elsewhere:
+        rss_unit = 1 if sys.platform == 'darwin' else 1024
+        snapshot['max_rss'] = own.ru_maxrss * rss_unit
+        snapshot['children_max_rss'] = children.ru_maxrss * rss_unit
+        snapshot['read_bytes'] = (own.ru_inblock + children.ru_inblock) * BLOCK_SIZE
+        snapshot['written_bytes'] = (own.ru_oublock + children.ru_oublock) * BLOCK_SIZE
+    return snapshot
+
+
+def total(records):
+    """Return a dict of the totals of FIELDS over a list of records, taking the maximum
+    rather than the sum of the PEAK_FIELDS that are not None"""
+    result = dict((field, 0) for field in FIELDS)
+    for field in PEAK_FIELDS:
+        peaks = [record[field] for record in records if record[field] is not None]
+        result[field] = max(peaks) if peaks else None
+    for record in records:
+        for field in FIELDS:
+            if field not in PEAK_FIELDS:
+                result[field] += record[field]
+    return result
+
+
+class PhaseRecorder(object):
+    """Records the resource usage of each phase of a conversion, used as:
+
+        recorder = PhaseRecorder()
+        with recorder.phase('convert'):
+            ...
+
+    recorder.phases is a list of dicts, one per phase in the order they ran, with the
+    name of the phase and each of FIELDS. A phase that raises an exception is recorded
+    too."""
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        before = usage()
+        try:
+            yield
+        finally:
+            after = usage()
+            record = {'phase': name}
+            for field in FIELDS:
+                if field in PEAK_FIELDS:
+                    # Only this phase's peak if it was reached during the phase:
+                    if after[field] > before[field]:
+                        record[field] = after[field]
+                    else:
+                        record[field] = None
+                else:
+                    record[field] = after[field] - before[field]
+            self.phases.append(record)
+
+
+def tool_version():
+    """Return the git commit of this tool, if it is a git checkout, otherwise None"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = ['git', 'describe', '--always', '--dirty']
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            output = subprocess.check_output(cmd, cwd=here, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def phase_totals(results):
+    """Return a dict of the totals of each phase across all results, in the order the
+    phases first appear"""
+    names = []
+    for result in results:
+        for record in result['phases']:
+            if record['phase'] not in names:
+                names.append(record['phase'])
+    return [
+        dict(
+            total(
+                [
+                    record
+                    for result in results
+                    for record in result['phases']
+                    if record['phase'] == name
+                ]
+            ),
+            phase=name,
+        )
+        for name in names
+    ]
+
+
+def write_json_report(filename, results):
+    from mercurial import util
+
+    report = {
+        'tool_version': tool_version(),
+        'mercurial_version': util.version().decode(),
+        'repos': [],
+        'phase_totals': phase_totals(results),
+    }
+    for result in results:
+        report['repos'].append(
+            {
+                'hg_repo': result['hg_repo'],
+                'git_repo': result['git_repo'],
+                'status': result['status'],
+                'phases': result['phases'],
+                'total': total(result['phases']),
+            }
+        )
+    report['total'] = total([repo['total'] for repo in report['repos']])
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+def write_csv_report(filename, results):
+    columns = ['hg_repo', 'git_repo', 'status', 'phase'] + FIELDS
+    rows = []
+    for result in results:
+        for record in result['phases'] + [dict(total(result['phases']), phase='total')]:
+            row = dict(record)
+            row.update(
+                hg_repo=result['hg_repo'],
+                git_repo=result['git_repo'],
+                status=result['status'],
+            )
+            rows.append(row)
+    # Totals across all repos have empty repo and status columns:
+    for record in phase_totals(results):
+        rows.append(record)
+    all_phases = [record for result in results for record in result['phases']]
+    rows.append(dict(total(all_phases), phase='total'))
+    with open(filename, 'w') as f:
+        writer = csv.DictWriter(f, columns, restval='', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_report(filename, results):
+    """Write a report of the phases of each result to filename, in CSV format if its
+    extension is .csv, otherwise JSON. Each result is a dict with keys 'hg_repo',
+    'git_repo', 'status' and 'phases', the latter as recorded by a PhaseRecorder.
+    Totals per repo, per phase across all repos, and overall are included."""
+    if os.path.splitext(filename)[1].lower() == '.csv':
+        write_csv_report(filename, results)
+    else:
+        write_json_report(filename, results)
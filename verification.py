@@ -0,0 +1,238 @@
+"""Verification that a git repository converted with hg-fast-export --hg-hash matches
+the mercurial repository it was converted from.
+
+Both repositories are streamed rather than loaded into memory: the git commits and
+their hg notes are read line by line from `git log`, and looked up in the hg changelog
+index, with a bitmap of the hg revisions seen. Optionally, the file trees of a sample
+of commits (every Nth revision, plus all heads and merges) are compared between the hg
+manifest and `git ls-tree`, on a pool of worker threads. Mismatches are reported as
+they are found.
+"""
+import os
+import sys
+import hashlib
+import threading
+import subprocess
+from binascii import hexlify, unhexlify
+from multiprocessing.pool import ThreadPool
+
+here = os.path.dirname(os.path.abspath(__file__))
+FAST_EXPORT_DIR = os.path.join(here, 'fast-export')
+if FAST_EXPORT_DIR not in sys.path:
+    sys.path.insert(0, FAST_EXPORT_DIR)
+from hg2git import setup_repo
+from mercurial import error, repoview
+
+# Files that hg-fast-export does not export as regular files:
+HG_SPECIAL_FILES = {b'.hgtags', b'.hgsub', b'.hgsubstate'}
+GIT_SPECIAL_FILES = {b'.gitmodules'}
+
+# Refs hg-fast-export keeps to commits that no branch contains yet, when it stops
+# partway:
+UNFINISHED_REFS = 'refs/hg2git/unfinished/*'
+
+
+class VerificationError(Exception):
+    pass
+
+
+def report_to_stderr(msg):
+    sys.stderr.write(msg + '\n')
+    sys.stderr.flush()
+
+
+def gitmode(flags):
+    return b'l' in flags and b'120000' or b'x' in flags and b'100755' or b'100644'
+
+
+def git_blob_hash(data):
+    """Return the hex hash git would give a blob with the given contents"""
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest().encode()
+
+
+def iter_git_notes(git_repo, git_revisions=None):
+    """Yield (git_hash, hg_hash) for each git commit reachable from git_revisions
+    (default: all branches, and the refs hg-fast-export keeps to commits of lines it
+    has not finished exporting), streamed from git log. hg_hash is None for commits
+    with no hg note."""
+    if git_revisions is None:
+        git_revisions = ['--branches', '--glob=' + UNFINISHED_REFS]
+    cmd = ['git', 'log', '--show-notes=hg', '--format=format:%H %N'] + git_revisions
+    proc = subprocess.Popen(cmd, cwd=git_repo, stdout=subprocess.PIPE)
+    try:
+        for line in proc.stdout:
+            fields = line.split()
+            if not fields:
+                continue
+            yield fields[0], fields[1] if len(fields) > 1 else None
+    finally:
+        proc.stdout.close()
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def iter_git_tree(git_repo, git_hash):
+    """Yield (path, mode, blob_hash) for each file in the tree of a git commit"""
+    cmd = ['git', 'ls-tree', '-r', '-z', '--full-tree', git_hash]
+    output = subprocess.check_output(cmd, cwd=git_repo)
+    for entry in output.split(b'\0'):
+        if not entry:
+            continue
+        info, path = entry.split(b'\t', 1)
+        mode, _, blob_hash = info.split(b' ')
+        yield path, mode, blob_hash
+
+
+class TreeChecker(object):
+    """Compares hg manifests with git trees for commits submitted with submit(), on a
+    pool of worker threads, each with its own hg repository object. The number of
+    commits waiting to be checked is bounded, so that submit() blocks if the workers
+    fall behind. Mismatches are passed to report() as they are found."""
+
+    def __init__(self, hg_repo, git_repo, jobs=1, contents=False, report=None):
+        self.hg_repo = hg_repo
+        self.git_repo = git_repo
+        self.contents = contents
+        self.report = report if report is not None else report_to_stderr
+        self.pool = ThreadPool(jobs)
+        self.slots = threading.BoundedSemaphore(4 * jobs)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.mismatches = 0
+        self.checked = 0
+        self.exception = None
+
+    def submit(self, rev, git_hash):
+        self.slots.acquire()
+        self.pool.apply_async(self._check, (rev, git_hash), callback=self._done)
+
+    def close(self):
+        """Wait for all submitted commits to be checked. Return the number of
+        mismatches found, raising any exception that occurred in a worker"""
+        self.pool.close()
+        self.pool.join()
+        if self.exception is not None:
+            raise self.exception
+        return self.mismatches
+
+    def _repo(self):
+        if not hasattr(self.local, 'repo'):
+            _, self.local.repo = setup_repo(self.hg_repo)
+        return self.local.repo
+
+    def _check(self, rev, git_hash):
+        try:
+            return self.compare(rev, git_hash), None
+        except Exception as e:
+            return [], e
+        finally:
+            self.slots.release()
+
+    def _done(self, result):
+        messages, exception = result
+        with self.lock:
+            self.checked += 1
+            if exception is not None and self.exception is None:
+                self.exception = exception
+            for msg in messages:
+                self.mismatches += 1
+                self.report(msg)
+
+    def compare(self, rev, git_hash):
+        """Return a list of messages describing differences between the hg manifest of
+        rev and the git tree of git_hash"""
+        repo = self._repo()
+        manifest = repo[rev].manifest()
+        hg_files = {}
+        for path in manifest:
+            if path in HG_SPECIAL_FILES or b'.git' in path.split(b'/'):
+                continue
+            hg_files[path] = manifest.flags(path)
+        prefix = 'r%d (git %s): ' % (rev, git_hash.decode())
+        messages = []
+        for path, mode, blob_hash in iter_git_tree(self.git_repo, git_hash):
+            if path in GIT_SPECIAL_FILES or mode == b'160000':
+                continue
+            name = path.decode('utf8', 'replace')
+            if path not in hg_files:
+                messages.append(prefix + '%s is not in hg' % name)
+                continue
+            hg_mode = gitmode(hg_files.pop(path))
+            if mode != hg_mode:
+                msg = '%s has mode %s in git but %s in hg'
+                messages.append(prefix + msg % (name, mode.decode(), hg_mode.decode()))
+            elif self.contents:
+                data = repo.file(path).read(manifest[path])
+                if git_blob_hash(data) != blob_hash:
+                    msg = '%s has different contents in git and hg'
+                    messages.append(prefix + msg % name)
+        for path in sorted(hg_files):
+            name = path.decode('utf8', 'replace')
+            messages.append(prefix + '%s is not in git' % name)
+        return messages
+
+
+def verify_conversion(hg_repo, git_repo, start_rev=0, stop_rev=None,
+                      git_revisions=None, tree_sample=0, contents=False, jobs=1,
+                      report=None):
+    """Verify that every visible hg changeset from start_rev up to stop_rev (default:
+    all) has a git commit annotated with its hash, and that every git commit reachable
+    from git_revisions (default: all branches and unfinished lines) is annotated with
+    the hash of an hg changeset.
+
+    If tree_sample is nonzero, also compare the file paths and modes of every
+    tree_sample'th revision, and of all heads and merges, between hg and git, using
+    `jobs` worker threads. If contents is True, file contents are compared too.
+
+    Mismatches are passed to report() (default: print to stderr) as they are found.
+    Return the number of mismatches."""
+    if report is None:
+        report = report_to_stderr
+    _, repo = setup_repo(hg_repo)
+    changelog = repo.changelog
+    hidden = repoview.filterrevs(repo, b'visible')
+    sample_revs = set()
+    if tree_sample:
+        visible = repo.filtered(b'visible')
+        sample_revs.update(visible.changelog.headrevs())
+        for branch in visible.branchmap():
+            for node in visible.branchheads(branch, closed=True):
+                sample_revs.add(changelog.rev(node))
+    checker = None
+    if tree_sample:
+        checker = TreeChecker(hg_repo, git_repo, jobs, contents, report)
+
+    mismatches = 0
+    seen = bytearray(len(changelog))
+    try:
+        for git_hash, hg_hash in iter_git_notes(git_repo, git_revisions):
+            if hg_hash is None:
+                report('git commit %s has no hg note' % git_hash.decode())
+                mismatches += 1
+                continue
+            try:
+                rev = changelog.rev(unhexlify(hg_hash))
+            except (error.LookupError, TypeError, ValueError):
+                msg = 'git commit %s has note %s, which is not an hg changeset'
+                report(msg % (git_hash.decode(), hg_hash.decode()))
+                mismatches += 1
+                continue
+            seen[rev] = 1
+            if checker is not None and (
+                rev % tree_sample == 0
+                or rev in sample_revs
+                or changelog.parentrevs(rev)[1] != -1
+            ):
+                checker.submit(rev, git_hash)
+    finally:
+        if checker is not None:
+            mismatches += checker.close()
+
+    if stop_rev is None or stop_rev > len(changelog):
+        stop_rev = len(changelog)
+    for rev in range(start_rev, stop_rev):
+        if not seen[rev] and rev not in hidden:
+            hg_hash = hexlify(changelog.node(rev)).decode()
+            report('hg hash %s has no corresponding git commit' % hg_hash)
+            mismatches += 1
+    return mismatches